@@ -0,0 +1,34 @@
+import argparse
+import json
+
+from benchmarks.harness import result_key
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare median timings of two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change reported as a regression or improvement")
+    arguments = parser.parse_args()
+
+    with open(arguments.baseline) as baseline_file:
+        baseline = {result_key(result): result for result in json.load(baseline_file)['results']}
+    with open(arguments.candidate) as candidate_file:
+        candidate = json.load(candidate_file)['results']
+
+    for result in candidate:
+        previous = baseline.get(result_key(result))
+        if previous is None:
+            continue
+        before = previous['stats']['median']
+        after = result['stats']['median']
+        change = (after - before) / before if before else 0.0
+        marker = "REGRESSION" if change > arguments.threshold else \
+            "improvement" if change < -arguments.threshold else ""
+        print(f"{result['name']:<40} {json.dumps(result['params']):<60} {before * 1000:10.3f} ms -> "
+              f"{after * 1000:10.3f} ms {change:+7.1%} {marker}")
+
+
+if __name__ == '__main__':
+    main()
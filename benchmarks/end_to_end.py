@@ -0,0 +1,146 @@
+from aiohttp.test_utils import TestClient, TestServer
+from collections import defaultdict
+from contextlib import contextmanager
+import asyncio
+import aiohttp
+import time
+
+from benchmarks.harness import Results, summarize
+from benchmarks.micro import generate_pdf
+from server.main import main
+
+KEY_POOL_WARMUP_TIMEOUT_SECONDS = 600
+
+
+class StepTimer:
+    _samples: dict[str, list[float]]
+
+    def __init__(self):
+        self._samples = defaultdict(list)
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        yield
+        self._samples[name].append(time.perf_counter() - start)
+
+    def report(self, results: Results, scenario: str, params: dict, elapsed: float):
+        for name, samples in self._samples.items():
+            results.add(f"{scenario}.{name}", params, summarize(samples))
+        lifecycles = len(self._samples['total'])
+        results.add(f"{scenario}.throughput", params, {**summarize([elapsed / lifecycles]),
+                                                       'lifecycles_per_second': lifecycles / elapsed})
+
+
+async def _expect_ok(response: aiohttp.ClientResponse) -> bytes:
+    body = await response.read()
+    if response.status != 200:
+        raise RuntimeError(f"{response.method} {response.url.path} answered {response.status}: {body[:200]!r}")
+    return body
+
+
+async def _wait_for_key_pool(client: TestClient):
+    # Rooms take their RSA key from the pool, so runs only compare if they start with a full one
+    deadline = time.monotonic() + KEY_POOL_WARMUP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        stats = await (await client.get('/getKeyPoolStats')).json()
+        if stats['depth'] >= stats['target_depth']:
+            return
+        await asyncio.sleep(0.5)
+    raise RuntimeError("Key pool did not fill up")
+
+
+async def _create_secret_room(client: TestClient, names: list[str], threshold: int) -> str:
+    response = await client.post('/createSecretRoom', json={'type': 'threshold', 'threshold': threshold,
+                                                            'names': names})
+    await _expect_ok(response)
+    return (await response.json())['room_id']
+
+
+async def _download_shares(client: TestClient, room_id: str, names: list[str]) -> list[bytes]:
+    return [await _expect_ok(await client.get(f'/downloadSecretShare/{room_id}/{name}')) for name in names]
+
+
+async def _signing_lifecycle(client: TestClient, timer: StepTimer, pdf_data: bytes, names: list[str],
+                             threshold: int):
+    with timer.step('total'):
+        with timer.step('create_secret_room'):
+            secret_room_id = await _create_secret_room(client, names, threshold)
+        with timer.step('download_shares'):
+            shares = await _download_shares(client, secret_room_id, names)
+        with timer.step('create_signing_room'):
+            form = aiohttp.FormData()
+            form.add_field('document', pdf_data, filename='document.pdf', content_type='application/pdf')
+            form.add_field('share', shares[0], filename='share.sss', content_type='application/octet-stream')
+            response = await client.post('/createSigningRoom', data=form)
+            await _expect_ok(response)
+            room = await response.json()
+        with timer.step('upload_shares'):
+            for share in shares[1:threshold]:
+                await _expect_ok(await client.post('/signDocument', params={'room_id': room['room_id']},
+                                                   data=share))
+        with timer.step('finish_signing'):
+            await _expect_ok(await client.post('/finishSigning', params={'room_id': room['room_id'],
+                                                                         'creator_token': room['creator_token']}))
+
+
+async def _reissue_lifecycle(client: TestClient, timer: StepTimer, names: list[str], threshold: int):
+    new_formula = f"T{threshold}({','.join(names + ['newcomer'])})"
+    with timer.step('total'):
+        with timer.step('create_secret_room'):
+            secret_room_id = await _create_secret_room(client, names, threshold)
+        with timer.step('download_shares'):
+            shares = await _download_shares(client, secret_room_id, names)
+        with timer.step('create_reissue_room'):
+            room_id = (await _expect_ok(await client.post('/createSecretReissueRoom',
+                                                          params={'formula': new_formula},
+                                                          data=shares[0]))).decode()
+        with timer.step('approve_shares'):
+            for share in shares[1:threshold]:
+                await _expect_ok(await client.post('/approveSecretReissue', params={'room_id': room_id},
+                                                   data=share))
+        with timer.step('download_reissued_shares'):
+            status = await (await client.get('/getSecretReissueRoom', params={'room_id': room_id})).json()
+            if status['links'] is None:
+                raise RuntimeError("Reissue did not complete")
+            for link in status['links'].values():
+                await _expect_ok(await client.get(link))
+
+
+async def _run_concurrently(clients: int, rounds: int, lifecycle) -> float:
+    async def client_rounds():
+        for _ in range(rounds):
+            await lifecycle()
+    start = time.perf_counter()
+    await asyncio.gather(*(client_rounds() for _ in range(clients)))
+    return time.perf_counter() - start
+
+
+async def run_async(results: Results, quick: bool):
+    client = TestClient(TestServer(await main()))
+    await client.start_server()
+    try:
+        await _wait_for_key_pool(client)
+        rounds = 1 if quick else 3
+        for clients, participants, threshold in ((1, 3, 2), (4, 5, 3), (16, 5, 3)):
+            names = [f"user{index}" for index in range(participants)]
+            for pages in ((10,) if quick else (1, 100)):
+                pdf_data = generate_pdf(pages)
+                timer = StepTimer()
+                elapsed = await _run_concurrently(clients, rounds, lambda: _signing_lifecycle(
+                    client, timer, pdf_data, names, threshold))
+                timer.report(results, "e2e_signing", {'clients': clients, 'participants': participants,
+                                                      'threshold': threshold, 'pages': pages}, elapsed)
+                await _wait_for_key_pool(client)
+            timer = StepTimer()
+            elapsed = await _run_concurrently(clients, rounds, lambda: _reissue_lifecycle(
+                client, timer, names, threshold))
+            timer.report(results, "e2e_reissue", {'clients': clients, 'participants': participants,
+                                                  'threshold': threshold}, elapsed)
+            await _wait_for_key_pool(client)
+    finally:
+        await client.close()
+
+
+def run(results: Results, quick: bool):
+    asyncio.run(run_async(results, quick))
@@ -0,0 +1,83 @@
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+import subprocess
+import statistics
+import platform
+import time
+import json
+import os
+
+
+def summarize(samples: list[float]) -> dict:
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'min': ordered[0],
+        'median': statistics.median(ordered),
+        'mean': statistics.fmean(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max': ordered[-1],
+        'stdev': statistics.stdev(ordered) if len(ordered) > 1 else 0.0
+    }
+
+
+def measure(function: Callable[[], object], repeat: int, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        function()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+async def measure_async(function: Callable[[], Awaitable[object]], repeat: int, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        await function()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await function()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Results:
+    # One benchmark run: environment details plus a list of named, parameterised timing summaries (seconds)
+    _results: list[dict]
+
+    def __init__(self):
+        self._results = []
+
+    def add(self, name: str, params: dict, stats: dict):
+        self._results.append({'name': name, 'params': params, 'stats': stats})
+        shown_params = " ".join(f"{key}={value}" for key, value in params.items())
+        print(f"{name:<40} {shown_params:<40} median {stats['median'] * 1000:10.3f} ms  "
+              f"p95 {stats['p95'] * 1000:10.3f} ms", flush=True)
+
+    def to_dict(self) -> dict:
+        return {
+            'commit': _git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'results': self._results
+        }
+
+    def write(self, path: str):
+        with open(path, "w") as results_file:
+            json.dump(self.to_dict(), results_file, indent=2)
+
+
+def result_key(result: dict) -> tuple:
+    return result['name'], json.dumps(result['params'], sort_keys=True)
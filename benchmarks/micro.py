@@ -0,0 +1,80 @@
+from cryptography.hazmat.primitives.asymmetric import rsa
+from pypdf import PdfWriter
+from io import BytesIO
+
+from benchmarks.harness import Results, measure
+from server.models import RoomsManagers
+from server.utils import utils
+import secret_sharing.__init__ as shamir_math_module
+
+KEY_SIZES = (2048, 4096)
+KEY_FORMAT_VERSIONS = (1, 2)
+THRESHOLDS = ((2, 3), (3, 5), (5, 9), (10, 15))
+PAGE_COUNTS = (1, 10, 100, 1000)
+QUICK_PAGE_COUNTS = (1, 10, 100)
+
+
+def _formula(threshold: int, participants: int, prefix: str = "p") -> str:
+    return f"T{threshold}({','.join(f'{prefix}{index}' for index in range(participants))})"
+
+
+def generate_pdf(pages: int) -> bytes:
+    pdf_writer = PdfWriter()
+    for _ in range(pages):
+        pdf_writer.add_blank_page(width=595, height=842)
+    bytes_io = BytesIO()
+    pdf_writer.write(bytes_io)
+    return bytes_io.getvalue()
+
+
+def bench_key_conversion(results: Results, repeat: int):
+    for key_size in KEY_SIZES:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        for format_version in KEY_FORMAT_VERSIONS:
+            params = {'key_size': key_size, 'format_version': format_version}
+            key_int = utils.private_key_to_int(key, format_version)
+            results.add("private_key_to_int", params,
+                        measure(lambda: utils.private_key_to_int(key, format_version), repeat))
+            results.add("int_to_private_key", params,
+                        measure(lambda: utils.int_to_private_key(key_int, key.public_key()), repeat))
+
+
+def bench_configuration(results: Results, repeat: int):
+    secret = utils.private_key_to_int(rsa.generate_private_key(public_exponent=65537, key_size=4096))
+    for threshold, participants in THRESHOLDS:
+        params = {'threshold': threshold, 'participants': participants}
+        formula = _formula(threshold, participants)
+        configuration = shamir_math_module.Configuration(modulo=RoomsManagers.CONFIGURATION_MODULO, formula=formula)
+        new_configuration = shamir_math_module.Configuration(modulo=RoomsManagers.CONFIGURATION_MODULO,
+                                                             formula=_formula(threshold, participants + 1, "q"))
+        parts = configuration.split(secret)
+        quorum = parts[:threshold]
+        results.add("configuration_parse", params, measure(
+            lambda: shamir_math_module.Configuration(modulo=RoomsManagers.CONFIGURATION_MODULO, formula=formula),
+            repeat))
+        results.add("configuration_split", params, measure(lambda: configuration.split(secret), repeat))
+        results.add("configuration_restore", params, measure(lambda: configuration.restore(quorum), repeat))
+        results.add("configuration_modify", params,
+                    measure(lambda: configuration.modify(new_configuration, quorum), repeat))
+
+
+def bench_pdf(results: Results, repeat: int, page_counts: tuple[int, ...]):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    public_numbers = key.public_key().public_numbers()
+    for pages in page_counts:
+        pdf_data = generate_pdf(pages)
+        signed_pdf_data = utils.add_signature_to_pdf(pdf_data, key)
+        # Large documents take seconds per call, a few samples are enough to compare
+        pdf_repeat = max(3, repeat // max(1, pages // 10))
+        params = {'pages': pages, 'bytes': len(pdf_data)}
+        results.add("add_signature_to_pdf", params, measure(lambda: utils.add_signature_to_pdf(pdf_data, key),
+                                                            pdf_repeat))
+        results.add("verify_pdf_signature", params, measure(
+            lambda: utils.verify_pdf_signature(signed_pdf_data, public_numbers.e, public_numbers.n), pdf_repeat))
+
+
+def run(results: Results, quick: bool):
+    repeat = 5 if quick else 30
+    bench_key_conversion(results, repeat)
+    bench_configuration(results, repeat)
+    bench_pdf(results, repeat, QUICK_PAGE_COUNTS if quick else PAGE_COUNTS)
@@ -0,0 +1,36 @@
+import argparse
+import os
+import sys
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# server/main.py imports its routes relative to the server directory, as when it is started directly
+sys.path.insert(0, os.path.join(REPOSITORY_DIRECTORY, "server"))
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+# Every benchmark client connects from the same address, per-client rate limiting would throttle the load itself
+os.environ.setdefault("SHAMIR_CLIENT_RATE_PER_SECOND", "0")
+
+from benchmarks.harness import Results  # noqa: E402
+
+SUITES = ("micro", "e2e")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmark suites and write their results as JSON")
+    parser.add_argument("--suite", choices=SUITES + ("all",), default="all")
+    parser.add_argument("--quick", action="store_true", help="fewer repetitions and smaller inputs")
+    parser.add_argument("--output", default="benchmark-results.json")
+    arguments = parser.parse_args()
+
+    results = Results()
+    if arguments.suite in ("micro", "all"):
+        from benchmarks import micro
+        micro.run(results, arguments.quick)
+    if arguments.suite in ("e2e", "all"):
+        from benchmarks import end_to_end
+        end_to_end.run(results, arguments.quick)
+    results.write(arguments.output)
+    print(f"Results written to {arguments.output}")
+
+
+if __name__ == '__main__':
+    main()
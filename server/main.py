@@ -1,8 +1,25 @@
+from server.utils import startup  # first, so that its timings cover every other import
 from aiohttp import web
 import aiohttp_cors
 from aiohttp_catcher import Catcher, catch
-from routes.APIHandlers import ROUTES_LIST
+from routes.APIHandlers import ROUTES_LIST, on_startup, on_cleanup
+from server.models import RoomsStore
+from server.models import PackedShares
+from server.utils import executor
+from server.utils import document_store
+from server.utils import share_format
+from server.utils import metrics
+from server.utils import profiling
 import asyncio
+import logging
+import signal
+import os
+
+SERVER_PORT = int(os.environ.get("SHAMIR_PORT", "8080"))
+SERVER_WORKERS = int(os.environ.get("SHAMIR_WORKERS", "1"))
+
+logger = logging.getLogger(__name__)
+startup.TIMINGS.mark("imports")
 
 
 async def main():
@@ -12,8 +29,32 @@ async def main():
         catch(Exception).with_status_code(400).with_additional_fields(
             {'type': 'ERROR', 'description': 'Something occured'}).and_return(None)
     )
-    server_app = web.Application(middlewares=[catcher.middleware])
+    await catcher.add_scenario(
+        catch(executor.ExecutorOverloadedError, executor.ExecutorTimeoutError).with_status_code(503)
+        .with_additional_fields({'type': 'ERROR', 'description': 'Server is busy'}).and_return(None)
+    )
+    await catcher.add_scenario(
+        catch(RoomsStore.RoomNotFoundError).with_status_code(400).with_additional_fields(
+            {'type': 'ERROR', 'description': 'Room not found'}).and_return(None)
+    )
+    await catcher.add_scenario(
+        catch(PackedShares.ShareNotAvailableError).with_status_code(400).with_additional_fields(
+            {'type': 'ERROR', 'description': 'Share not available'}).and_return(None)
+    )
+    await catcher.add_scenario(
+        catch(document_store.DocumentTooLargeError).with_status_code(413).with_additional_fields(
+            {'type': 'ERROR', 'description': 'Document is too large'}).and_return(None)
+    )
+    await catcher.add_scenario(
+        catch(share_format.ShareFormatError).with_status_code(400).with_additional_fields(
+            {'type': 'ERROR', 'description': 'Malformed share file'}).and_return(None)
+    )
+    server_app = web.Application(middlewares=[catcher.middleware, metrics.middleware, profiling.middleware])
     server_app.add_routes(ROUTES_LIST)
+    # Admin only, see profiling.ADMIN_TOKEN
+    server_app.add_routes(profiling.ROUTES_LIST)
+    server_app.on_startup.append(on_startup)
+    server_app.on_cleanup.append(on_cleanup)
     cors = aiohttp_cors.setup(server_app, defaults={
         "*": aiohttp_cors.ResourceOptions(
             allow_credentials=True,
@@ -25,9 +66,49 @@ async def main():
     for route in list(server_app.router.routes()):
         cors.add(route)
 
+    startup.TIMINGS.mark("app_init")
     return server_app
 
 
-if __name__ == '__main__':
+def run_worker(reuse_port: bool):
     server = asyncio.run(main())
-    web.run_app(server)
+    web.run_app(server, port=SERVER_PORT, reuse_port=reuse_port)
+
+
+def run_workers(workers_count: int):
+    # Pre-fork: every worker binds its own SO_REUSEPORT socket and the kernel spreads connections between them.
+    # Room state is shared through the rooms database, see RoomsStore.SharedRoomsStore.
+    children = []
+    for _ in range(workers_count):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                run_worker(reuse_port=True)
+            except BaseException:
+                logger.exception("Worker %d failed", os.getpid())
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children.append(pid)
+
+    def forward_signal(signal_number, frame):
+        for child in children:
+            try:
+                os.kill(child, signal_number)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGINT, forward_signal)
+    for child in children:
+        _, status = os.waitpid(child, 0)
+        if status != 0:
+            logger.error("Worker %d exited with status %d", child, status)
+
+
+if __name__ == '__main__':
+    if SERVER_WORKERS > 1:
+        run_workers(SERVER_WORKERS)
+    else:
+        run_worker(reuse_port=False)
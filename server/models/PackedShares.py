@@ -0,0 +1,97 @@
+from typing import Iterable, Iterator
+from server.utils.utils import SERIALIZATION_ENDIAN
+
+_LENGTH_SIZE = 4
+
+
+class ShareNotAvailableError(Exception):
+    pass
+
+
+def _pack_values(values: list[int]) -> bytes:
+    chunks = []
+    for value in values:
+        value_bytes = value.to_bytes((value.bit_length() + 7) // 8, SERIALIZATION_ENDIAN)
+        chunks.append(len(value_bytes).to_bytes(_LENGTH_SIZE, SERIALIZATION_ENDIAN))
+        chunks.append(value_bytes)
+    return b"".join(chunks)
+
+
+def _unpack_values(buffer: memoryview) -> list[int]:
+    values = []
+    offset = 0
+    while offset < len(buffer):
+        value_end = offset + _LENGTH_SIZE + int.from_bytes(buffer[offset:offset + _LENGTH_SIZE], SERIALIZATION_ENDIAN)
+        values.append(int.from_bytes(buffer[offset + _LENGTH_SIZE:value_end], SERIALIZATION_ENDIAN))
+        offset = value_end
+    return values
+
+
+class PackedShares:
+    # The shares of one room in a single bytes buffer instead of a Part with a list of ints per participant: every
+    # value is a 4 byte length followed by its magnitude. _index maps participant names, in insertion order, to the
+    # (offset, size) of their values in the buffer, or to None once the share was handed out and dropped.
+    __slots__ = ("_buffer", "_index")
+    _buffer: bytes
+    _index: dict[str, tuple[int, int] | None]
+
+    def __init__(self, shares: Iterable[tuple[str, list[int] | None]] = ()):
+        self._index = {}
+        chunks = []
+        offset = 0
+        for name, values in shares:
+            if values is None:
+                self._index[name] = None
+                continue
+            chunk = _pack_values(values)
+            self._index[name] = (offset, len(chunk))
+            chunks.append(chunk)
+            offset += len(chunk)
+        self._buffer = b"".join(chunks)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def add(self, name: str, values: list[int]) -> bool:
+        # The first share of a participant is kept, returns whether this one was added
+        if name in self._index:
+            return False
+        chunk = _pack_values(values)
+        self._index[name] = (len(self._buffer), len(chunk))
+        self._buffer += chunk
+        return True
+
+    def available(self, name: str) -> bool:
+        return self._index.get(name) is not None
+
+    def get(self, name: str) -> list[int] | None:
+        location = self._index[name]
+        if location is None:
+            return None
+        offset, size = location
+        return _unpack_values(memoryview(self._buffer)[offset:offset + size])
+
+    def pop(self, name: str) -> list[int]:
+        # Hands a share out once: its bytes leave the buffer, the name stays known
+        if not self.available(name):
+            raise ShareNotAvailableError(name)
+        values = self.get(name)
+        offset, size = self._index[name]
+        self._buffer = self._buffer[:offset] + self._buffer[offset + size:]
+        self._index[name] = None
+        for other_name, location in self._index.items():
+            if location is not None and location[0] > offset:
+                self._index[other_name] = (location[0] - size, location[1])
+        return values
+
+    def items(self) -> list[tuple[str, list[int] | None]]:
+        return [(name, self.get(name)) for name in self._index]
+
+    def nbytes(self) -> int:
+        return len(self._buffer) + sum(len(name) for name in self._index)
@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+import asyncio
+import os
+
+EVENTS_QUEUE_SIZE = int(os.environ.get("SHAMIR_EVENTS_QUEUE_SIZE", "64"))
+
+
+class RoomsEvents:
+    # Per-room fan-out of room events to the subscribers of this process. A subscriber that falls more than
+    # EVENTS_QUEUE_SIZE events behind loses the oldest ones; every status event carries the full room status,
+    # so the latest one is always enough to catch up.
+    _subscribers: dict[str, set[asyncio.Queue]]
+    _queue_size: int
+
+    def __init__(self, queue_size: int = EVENTS_QUEUE_SIZE):
+        self._subscribers = {}
+        self._queue_size = queue_size
+        self._published_count = 0
+        self._dropped_count = 0
+
+    @contextmanager
+    def subscription(self, room_id: str):
+        queue = asyncio.Queue(maxsize=self._queue_size)
+        self._subscribers.setdefault(room_id, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers[room_id].discard(queue)
+            if not self._subscribers[room_id]:
+                del self._subscribers[room_id]
+
+    def has_subscribers(self, room_id: str) -> bool:
+        return room_id in self._subscribers
+
+    def publish(self, room_id: str, event: str, data: dict):
+        for queue in self._subscribers.get(room_id, ()):
+            if queue.full():
+                queue.get_nowait()
+                self._dropped_count += 1
+            queue.put_nowait((event, data))
+            self._published_count += 1
+
+    def stats(self) -> dict:
+        return {
+            'rooms': len(self._subscribers),
+            'subscribers': sum(len(queues) for queues in self._subscribers.values()),
+            'published': self._published_count,
+            'dropped': self._dropped_count
+        }
@@ -0,0 +1,58 @@
+from contextlib import asynccontextmanager
+from zlib import crc32
+import asyncio
+import fcntl
+import os
+
+LOCK_BUCKETS = 1024
+LOCK_POLL_SECONDS = 0.005
+
+
+class RoomsLocks:
+    # Serialises read-modify-write sequences on one room. Within a process an asyncio.Lock per room is enough; with
+    # a lock directory the holder additionally takes an flock on one of LOCK_BUCKETS files, so that server processes
+    # sharing the rooms database exclude each other too.
+    _locks: dict[str, asyncio.Lock]
+    _users: dict[str, int]
+    _directory: str
+
+    def __init__(self, directory: str = None):
+        self._locks = {}
+        self._users = {}
+        self._directory = directory
+
+    def _lock_path(self, room_id: str) -> str:
+        return os.path.join(self._directory, f"{crc32(room_id.encode()) % LOCK_BUCKETS}.lock")
+
+    async def _acquire_file_lock(self, room_id: str) -> int:
+        os.makedirs(self._directory, exist_ok=True)
+        lock_fd = os.open(self._lock_path(room_id), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            while True:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return lock_fd
+                except BlockingIOError:
+                    await asyncio.sleep(LOCK_POLL_SECONDS)
+        except BaseException:
+            os.close(lock_fd)
+            raise
+
+    @asynccontextmanager
+    async def hold(self, room_id: str):
+        lock = self._locks.setdefault(room_id, asyncio.Lock())
+        self._users[room_id] = self._users.get(room_id, 0) + 1
+        try:
+            async with lock:
+                lock_fd = await self._acquire_file_lock(room_id) if self._directory is not None else None
+                try:
+                    yield
+                finally:
+                    if lock_fd is not None:
+                        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+                        os.close(lock_fd)
+        finally:
+            self._users[room_id] -= 1
+            if not self._users[room_id]:
+                del self._users[room_id]
+                del self._locks[room_id]
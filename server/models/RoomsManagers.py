@@ -1,9 +1,26 @@
 from datetime import datetime
+from server.models.RoomsStore import RoomsStore, SharedRoomsStore
+from server.models.RoomsLocks import RoomsLocks
+from server.models.PackedShares import PackedShares, ShareNotAvailableError
+from server.models import RoomsPersistence
 from server.utils import utils
-import secret_sharing.__init__ as shamir_math_module
+from server.utils import key_pool
+from server.utils import executor
+from server.utils import document_store
+from server.utils import metrics
+from server.utils.access_structure import AccessStructure, FormulaParseError
 from cryptography.hazmat.primitives.asymmetric import rsa
+from functools import lru_cache
+from typing import TYPE_CHECKING
+from array import array
+import asyncio
 import random
 import string
+import sys
+import os
+
+if TYPE_CHECKING:
+    import secret_sharing
 
 CONFIGURATION_MODULO = int("2889319989747198508017897377754761759953328277718754812082417603477570842702413950136716111"
                            "4253125522907640180566965220783523146817894334026799437526739377193559559759889067003401856"
@@ -19,6 +36,151 @@ CONFIGURATION_MODULO = int("2889319989747198508017897377754761759953328277718754
                            "5744425590033704088141455053437189109095709767466367466947490692741916306743994840604477651"
                            "0821456681379928554673026860125006056160091726631821837704458773169723051070221270445735400"
                            "48557191607576051060248378262129303185824081872165173389833458016853826300737741498501823")
+CONFIGURATION_CACHE_SIZE = int(os.environ.get("SHAMIR_CONFIGURATION_CACHE_SIZE", "256"))
+# Executor timeouts per operation: share math on its own is quick, restoring the key and signing a large document
+# is what can legitimately take long
+SPLIT_TIMEOUT_SECONDS = float(os.environ.get("SHAMIR_SPLIT_TIMEOUT_SECONDS", "30"))
+RESTORABLE_CHECK_TIMEOUT_SECONDS = float(os.environ.get("SHAMIR_RESTORABLE_CHECK_TIMEOUT_SECONDS", "30"))
+SIGN_TIMEOUT_SECONDS = float(os.environ.get("SHAMIR_SIGN_TIMEOUT_SECONDS", "120"))
+REISSUE_TIMEOUT_SECONDS = float(os.environ.get("SHAMIR_REISSUE_TIMEOUT_SECONDS", "60"))
+
+
+def _shamir_math_module():
+    # secret_sharing is imported on first use rather than at startup, executor workers import it during warm_up()
+    import secret_sharing.__init__ as shamir_math_module
+    return shamir_math_module
+
+
+def warm_up():
+    utils.warm_up()
+    _shamir_math_module()
+
+
+def _parts_to_tuples(parts: list["secret_sharing.Part"]) -> list[tuple[str, list[int]]]:
+    return [(part.name, part.values) for part in parts]
+
+
+def _tuples_to_parts(tuples: list[tuple[str, list[int]]]) -> list["secret_sharing.Part"]:
+    return [_shamir_math_module().Part(name, values) for name, values in tuples]
+
+
+# Rooms mostly reuse a handful of policies, so parsed configurations are shared per process (and per executor
+# worker process) instead of being rebuilt for every room and every restore
+@lru_cache(maxsize=CONFIGURATION_CACHE_SIZE)
+def _configuration(formula: str, version: int = None) -> "secret_sharing.Configuration":
+    shamir_math_module = _shamir_math_module()
+    if version is None:
+        return shamir_math_module.Configuration(modulo=CONFIGURATION_MODULO, formula=formula)
+    return shamir_math_module.Configuration(modulo=CONFIGURATION_MODULO, formula=formula, version=version)
+
+
+# Shared per formula like configurations, None for formulas beyond the access structure parser
+@lru_cache(maxsize=CONFIGURATION_CACHE_SIZE)
+def _access_structure(formula: str) -> AccessStructure:
+    try:
+        return AccessStructure(formula)
+    except FormulaParseError:
+        return None
+
+
+def _quorum_counts(formula: str, names) -> (array, bool):
+    # Gate counts a room keeps to track its quorum share by share, and whether the names satisfy the formula.
+    # (None, None) when only a trial restore can tell.
+    access_structure = _access_structure(formula)
+    if access_structure is None:
+        return None, None
+    gate_counts = access_structure.counts()
+    reached = False
+    for name in names:
+        reached = access_structure.add(gate_counts, name)
+    return gate_counts, reached
+
+
+def configuration_cache_stats() -> dict:
+    cache_info = _configuration.cache_info()
+    return {
+        'size': cache_info.currsize,
+        'max_size': cache_info.maxsize,
+        'hits': cache_info.hits,
+        'misses': cache_info.misses
+    }
+
+
+# Worker-side entry points for executor.COMPUTE_EXECUTOR: module-level and operating on plain data only,
+# so they can be shipped to a process pool
+def _split_secret(formula: str, secret: int) -> list[tuple[str, list[int]]]:
+    configuration = _configuration(formula)
+    with metrics.stage("split"):
+        return _parts_to_tuples(configuration.split(secret))
+
+
+def _is_secret_restorable(formula: str, shares: list[tuple[str, list[int]]]) -> bool:
+    configuration = _configuration(formula)
+    with metrics.stage("restore"):
+        return configuration.restore(_tuples_to_parts(shares)) is not None
+
+
+def _sign_document(formula: str, shares: list[tuple[str, list[int]]], public_n: int, public_e: int,
+                   pdf_path: str, canonical_pdf_path: str, signed_pdf_path: str) -> document_store.StoredDocument:
+    configuration = _configuration(formula)
+    with metrics.stage("restore"):
+        restored_secret = configuration.restore(_tuples_to_parts(shares))
+    restored_key = utils.int_to_private_key(restored_secret, rsa.RSAPublicNumbers(public_e, public_n).public_key())
+    canonical_pdf_binary, hash_value = document_store.canonical_document(pdf_path, canonical_pdf_path)
+    signed_pdf_binary = utils.sign_canonical_pdf(canonical_pdf_binary, hash_value, restored_key)
+    return document_store.write_document(signed_pdf_path, signed_pdf_binary)
+
+
+def _reissue_shares(formula: str, new_formula: str, format_version: int,
+                    shares: list[tuple[str, list[int]]]) -> list[tuple[str, list[int]]]:
+    configuration = _configuration(formula, format_version)
+    new_configuration = _configuration(new_formula, format_version)
+    with metrics.stage("modify"):
+        return _parts_to_tuples(configuration.modify(new_configuration, _tuples_to_parts(shares)))
+
+
+# Persisted records store integers as hex strings: linear to convert, unlike multi-thousand-digit decimals
+def _encode_shares(shares: PackedShares) -> list:
+    return [[name, None if values is None else [format(value, "x") for value in values]]
+            for name, values in shares.items()]
+
+
+def _decode_shares(encoded: list) -> PackedShares:
+    return PackedShares((name, None if values is None else [int(value, 16) for value in values])
+                        for name, values in encoded)
+
+
+def _encode_public_key(public_key: rsa.RSAPublicKey) -> dict:
+    public_numbers = public_key.public_numbers()
+    return {'n': format(public_numbers.n, "x"), 'e': format(public_numbers.e, "x")}
+
+
+def _decode_public_key(encoded: dict) -> rsa.RSAPublicKey:
+    return rsa.RSAPublicNumbers(int(encoded['e'], 16), int(encoded['n'], 16)).public_key()
+
+
+def _encode_document(document: document_store.StoredDocument) -> dict:
+    if document is None:
+        return None
+    return {'path': document.path, 'size': document.size, 'sha256': document.sha256}
+
+
+def _decode_document(encoded: dict) -> document_store.StoredDocument:
+    if encoded is None:
+        return None
+    return document_store.StoredDocument(encoded['path'], encoded['size'], encoded['sha256'])
+
+
+def _rooms_store(kind: str, load_room, on_evict=None) -> RoomsStore | SharedRoomsStore:
+    if RoomsPersistence.SHARED_STATE:
+        return SharedRoomsStore(RoomsPersistence.DATABASE, kind, load_room, on_evict=on_evict)
+    return RoomsStore(on_evict=on_evict, persistence=RoomsPersistence.persistence_for(kind), load_room=load_room)
+
+
+def _rooms_locks() -> RoomsLocks:
+    if RoomsPersistence.SHARED_STATE:
+        return RoomsLocks(RoomsPersistence.DATABASE.path + ".locks")
+    return RoomsLocks()
 
 
 def _generate_room_id() -> str:
@@ -32,189 +194,424 @@ def _generate_room_id() -> str:
 
 
 class SecretCreationRoomStoredData:
+    __slots__ = ("creation_datetime", "identifier", "participants_shares", "public_key", "formula", "format_version")
     creation_datetime: datetime
     identifier: str
-    participants_shares: list[shamir_math_module.Part]
+    participants_shares: PackedShares
     public_key: rsa.RSAPublicKey
     formula: str
     format_version: int
 
-    def __init__(self, key_splitted: list[shamir_math_module.Part], public_key: rsa.RSAPublicKey, formula: str,
-                 format_version: int):
+    def __init__(self, key_splitted: PackedShares, public_key: rsa.RSAPublicKey, formula: str, format_version: int):
         self.creation_datetime = datetime.now()
         self.identifier = _generate_room_id()
         self.participants_shares = key_splitted
         self.public_key = public_key
-        self.formula = formula
+        self.formula = sys.intern(formula)
         self.format_version = format_version
 
     def pop_share_by_user(self, user_id: str) -> list[int]:
-        for index, user in enumerate(self.participants_shares):
-            if user.name == user_id and user.values is not None:
-                to_return = user.values
-                self.participants_shares[index].values = None
-                return to_return
-        raise Exception()
+        return self.participants_shares.pop(user_id)
+
+    def stored_size(self) -> int:
+        return self.participants_shares.nbytes()
+
+    def to_record(self) -> dict:
+        return {
+            'identifier': self.identifier,
+            'creation_datetime': self.creation_datetime.timestamp(),
+            'participants_shares': _encode_shares(self.participants_shares),
+            'public_key': _encode_public_key(self.public_key),
+            'formula': self.formula,
+            'format_version': self.format_version
+        }
+
+    @classmethod
+    def from_record(cls, record: dict) -> "SecretCreationRoomStoredData":
+        room = cls.__new__(cls)
+        room.creation_datetime = datetime.fromtimestamp(record['creation_datetime'])
+        room.identifier = record['identifier']
+        room.participants_shares = _decode_shares(record['participants_shares'])
+        room.public_key = _decode_public_key(record['public_key'])
+        room.formula = sys.intern(record['formula'])
+        room.format_version = record['format_version']
+        return room
 
 
 class SecretCreationRoomsManager:
-    _stored_rooms: list[SecretCreationRoomStoredData]
+    _stored_rooms: RoomsStore | SharedRoomsStore
+    _locks: RoomsLocks
+    key_pool: key_pool.RSAKeyPool
 
-    def __init__(self):
-        self._stored_rooms = []
+    def __init__(self, rsa_key_pool: key_pool.RSAKeyPool = None):
+        self._stored_rooms = _rooms_store("secret_creation", SecretCreationRoomStoredData.from_record)
+        self._locks = _rooms_locks()
+        self.key_pool = rsa_key_pool if rsa_key_pool is not None else key_pool.RSAKeyPool()
 
-    def create_room(self, participants_lists: list, formula: str) -> str:
-        key = rsa.generate_private_key(public_exponent=65537, key_size=4096)
+    async def create_room(self, participants_lists: list, formula: str) -> str:
+        key = await self.key_pool.acquire()
         key_int = utils.private_key_to_int(key)
-        configuration = shamir_math_module.Configuration(modulo=CONFIGURATION_MODULO, formula=formula)
-        key_splitted = configuration.split(key_int)
+        key_splitted = PackedShares(await executor.COMPUTE_EXECUTOR.run(_split_secret, formula, key_int,
+                                                                        timeout=SPLIT_TIMEOUT_SECONDS))
         new_room = SecretCreationRoomStoredData(key_splitted, key.public_key(), formula, 1)
-        self._stored_rooms.append(new_room)
+        await self._stored_rooms.put(new_room)
         return new_room.identifier
 
     def get_room_stored_data(self, room_id: str) -> SecretCreationRoomStoredData:
-        for room in self._stored_rooms:
-            if room.identifier == room_id:
-                return room
-        raise Exception()
+        return self._stored_rooms.get(room_id)
+
+    async def save_room_stored_data(self, room: SecretCreationRoomStoredData):
+        await self._stored_rooms.update(room)
+
+    def room_lock(self, room_id: str):
+        return self._locks.hold(room_id)
+
+    def start(self):
+        self.key_pool.start()
+        self._stored_rooms.start()
+
+    async def stop(self):
+        await self._stored_rooms.stop()
+        await self.key_pool.stop()
+
+    def stats(self) -> dict:
+        return self._stored_rooms.stats()
 
 
 class DocumentSigningRoomStoredData:
+    __slots__ = ("creation_datetime", "identifier", "creator_token", "participants_shares", "participants_count",
+                 "public_key", "formula", "pdf_document", "pdf_name", "signed_pdf_document", "format_version",
+                 "_signing_available", "_gate_counts")
     creation_datetime: datetime
     identifier: str
     creator_token: str
-    participants_shares: list[shamir_math_module.Part]
+    participants_shares: PackedShares
     participants_count: int
     public_key: rsa.RSAPublicKey
     formula: str
-    pdf_binary: bytes
+    pdf_document: document_store.StoredDocument
     pdf_name: str
-    signed_pdf_binary: bytes
+    signed_pdf_document: document_store.StoredDocument
     format_version: int
+    _signing_available: bool
+    _gate_counts: array
 
-    def __init__(self, initial_share: shamir_math_module.Part, public_key: rsa.RSAPublicKey, formula: str,
-                 pdf_binary: bytes, pdf_name: str, format_version: int):
+    def __init__(self, initial_share: tuple[str, list[int]], public_key: rsa.RSAPublicKey, formula: str,
+                 pdf_document: document_store.StoredDocument, pdf_name: str, format_version: int):
         self.creation_datetime = datetime.now()
         self.identifier = _generate_room_id()
         self.creator_token = _generate_room_id()
-        self.participants_shares = [initial_share]
+        self.participants_shares = PackedShares([initial_share])
         self.public_key = public_key
-        self.pdf_binary = pdf_binary
+        self.pdf_document = pdf_document
         self.pdf_name = pdf_name
-        self.formula = formula
-        self.signed_pdf_binary = None
+        self.formula = sys.intern(formula)
+        self.signed_pdf_document = None
         self.format_version = format_version
-        self._configuration = shamir_math_module.Configuration(modulo=CONFIGURATION_MODULO, formula=formula)
-        self.participants_count = len(self._configuration.names())
+        self._init_quorum()
 
-    def add_share(self, name: str, share_values: list[int]):
-        if not (shamir_math_module.Part(name, share_values) in self.participants_shares):
-            self.participants_shares.append(shamir_math_module.Part(name, share_values))
+    def _init_quorum(self):
+        self.participants_count = len(_configuration(self.formula).names())
+        self._gate_counts, self._signing_available = _quorum_counts(self.formula, self.participants_shares)
 
-    def finish_signing(self, creator_token: str) -> bool:
+    def add_share(self, name: str, share_values: list[int]):
+        if not self.participants_shares.add(name, share_values):
+            return
+        if self._gate_counts is None:
+            # Formulas we cannot evaluate ourselves fall back to a trial restore, cached until the next share
+            self._signing_available = None
+        elif not self._signing_available:
+            # Once reached the quorum stays reached, later shares are not counted
+            self._signing_available = _access_structure(self.formula).add(self._gate_counts, name)
+
+    async def finish_signing(self, creator_token: str) -> bool:
         if creator_token == self.creator_token:
-            restored_secret = self._configuration.restore(self.participants_shares)
-            restored_key = utils.int_to_private_key(restored_secret, self.public_key)
-            self.signed_pdf_binary = utils.add_signature_to_pdf(self.pdf_binary, restored_key)
+            if self.signed_pdf_document is not None:
+                # The key is fixed by the room, so the document signed first stays valid for good
+                return 0
+            if not await self.signing_available():
+                return 1
+            public_numbers = self.public_key.public_numbers()
+            signed_pdf_document = await executor.COMPUTE_EXECUTOR.run(
+                _sign_document, self.formula, self.participants_shares.items(),
+                public_numbers.n, public_numbers.e, self.pdf_document.path,
+                document_store.DOCUMENT_STORE.canonical_path(self.pdf_document.sha256),
+                document_store.DOCUMENT_STORE.reserve_path(), timeout=SIGN_TIMEOUT_SECONDS)
+            self.signed_pdf_document = signed_pdf_document
             return 0
         return 1
 
-    def signing_available(self) -> bool:
-        if self._configuration.restore(self.participants_shares) is not None:
-            return True
-        return False
+    async def signing_available(self) -> bool:
+        if self._signing_available is None:
+            shares_count = len(self.participants_shares)
+            available = await executor.COMPUTE_EXECUTOR.run(_is_secret_restorable, self.formula,
+                                                            self.participants_shares.items(),
+                                                            timeout=RESTORABLE_CHECK_TIMEOUT_SECONDS)
+            if shares_count == len(self.participants_shares):
+                self._signing_available = available
+            return available
+        return self._signing_available
+
+    def stored_size(self) -> int:
+        size = self.participants_shares.nbytes() + self.pdf_document.size
+        if self.signed_pdf_document is not None:
+            size += self.signed_pdf_document.size
+        return size
+
+    def discard(self):
+        self.pdf_document.discard()
+        if self.signed_pdf_document is not None:
+            self.signed_pdf_document.discard()
+
+    def to_record(self) -> dict:
+        return {
+            'identifier': self.identifier,
+            'creation_datetime': self.creation_datetime.timestamp(),
+            'creator_token': self.creator_token,
+            'participants_shares': _encode_shares(self.participants_shares),
+            'public_key': _encode_public_key(self.public_key),
+            'formula': self.formula,
+            'pdf_document': _encode_document(self.pdf_document),
+            'pdf_name': self.pdf_name,
+            'signed_pdf_document': _encode_document(self.signed_pdf_document),
+            'format_version': self.format_version
+        }
+
+    @classmethod
+    def from_record(cls, record: dict) -> "DocumentSigningRoomStoredData":
+        room = cls.__new__(cls)
+        room.creation_datetime = datetime.fromtimestamp(record['creation_datetime'])
+        room.identifier = record['identifier']
+        room.creator_token = record['creator_token']
+        room.participants_shares = _decode_shares(record['participants_shares'])
+        room.public_key = _decode_public_key(record['public_key'])
+        room.formula = sys.intern(record['formula'])
+        room.pdf_document = _decode_document(record['pdf_document'])
+        room.pdf_name = record['pdf_name']
+        room.signed_pdf_document = _decode_document(record['signed_pdf_document'])
+        room.format_version = record['format_version']
+        room._init_quorum()
+        return room
 
 
 class DocumentSigningRoomsManager:
-    _stored_rooms: list[SecretCreationRoomStoredData]
+    _stored_rooms: RoomsStore | SharedRoomsStore
+    _locks: RoomsLocks
+    _signing: dict[str, asyncio.Future]
 
     def __init__(self):
-        self._stored_rooms = []
-
-    def create_room(self, name: str, values: list[int], public_n: int, public_e: int, formula: str,
-                    pdf_binary: bytes, pdf_name: str, format_version: int) -> (str, str):
-        new_room = DocumentSigningRoomStoredData(shamir_math_module.Part(name, values),
+        self._stored_rooms = _rooms_store("document_signing", DocumentSigningRoomStoredData.from_record,
+                                          on_evict=DocumentSigningRoomStoredData.discard)
+        self._locks = _rooms_locks()
+        self._signing = {}
+
+    async def create_room(self, name: str, values: list[int], public_n: int, public_e: int, formula: str,
+                          pdf_document: document_store.StoredDocument, pdf_name: str,
+                          format_version: int) -> (str, str):
+        new_room = DocumentSigningRoomStoredData((name, values),
                                                  rsa.RSAPublicNumbers(public_e, public_n).public_key(),
                                                  formula,
-                                                 pdf_binary, pdf_name, format_version)
-        self._stored_rooms.append(new_room)
+                                                 pdf_document, pdf_name, format_version)
+        await self._stored_rooms.put(new_room)
         return new_room.identifier, new_room.creator_token
 
     def get_room_stored_data(self, room_id: str) -> DocumentSigningRoomStoredData:
-        for room in self._stored_rooms:
-            if room.identifier == room_id:
-                return room
-        raise Exception()
+        return self._stored_rooms.get(room_id)
+
+    async def save_room_stored_data(self, room: DocumentSigningRoomStoredData):
+        await self._stored_rooms.update(room)
+
+    def room_lock(self, room_id: str):
+        return self._locks.hold(room_id)
+
+    async def finish_signing(self, room_id: str, creator_token: str) -> (DocumentSigningRoomStoredData, bool):
+        # Single flight: concurrent callers of one room await the same signing run. Other processes sharing the
+        # rooms database wait for the room lock instead and then find the signed document already stored.
+        # Returns the room (None for a wrong token or a missing quorum) and whether this call signed the document.
+        if self.get_room_stored_data(room_id).creator_token != creator_token:
+            return None, False
+        signing = self._signing.get(room_id)
+        leader = signing is None
+        if leader:
+            signing = asyncio.ensure_future(self._finish_signing(room_id, creator_token))
+            self._signing[room_id] = signing
+            signing.add_done_callback(lambda future: self._forget_signing(room_id, future))
+        room, signed_now = await asyncio.shield(signing)
+        return room, leader and signed_now
+
+    async def _finish_signing(self, room_id: str, creator_token: str) -> (DocumentSigningRoomStoredData, bool):
+        async with self.room_lock(room_id):
+            room = self.get_room_stored_data(room_id)
+            already_signed = room.signed_pdf_document is not None
+            if await room.finish_signing(creator_token):
+                return None, False
+            if not already_signed:
+                await self.save_room_stored_data(room)
+            return room, not already_signed
+
+    def _forget_signing(self, room_id: str, signing: asyncio.Future):
+        del self._signing[room_id]
+        if not signing.cancelled():
+            # Marks a failure as retrieved even when every caller went away before it was raised
+            signing.exception()
+
+    def start(self):
+        self._stored_rooms.start()
+
+    async def stop(self):
+        await self._stored_rooms.stop()
+
+    def stats(self) -> dict:
+        return {**self._stored_rooms.stats(), 'signing_in_flight': len(self._signing)}
 
 
 class SecretReissueRoomStoredData:
+    __slots__ = ("creation_datetime", "identifier", "participants_shares", "formula", "new_formula",
+                 "participants_new_shares", "participants_count", "format_version", "public_key", "_quorum_reached",
+                 "_gate_counts", "_attempted_shares_count")
     creation_datetime: datetime
     identifier: str
-    participants_shares: list[shamir_math_module.Part]
+    participants_shares: PackedShares
     formula: str
     new_formula: str
-    participants_new_shares: list[shamir_math_module.Part]
+    participants_new_shares: PackedShares
     participants_count: int
     format_version: int
     public_key: rsa.RSAPublicKey
-    _configuration: shamir_math_module.Configuration
-    _new_configuration: shamir_math_module.Configuration
+    _quorum_reached: bool
+    _gate_counts: array
+    _attempted_shares_count: int
 
-    def __init__(self, initial_share: shamir_math_module.Part, public_key: rsa.RSAPublicKey, formula: str,
+    def __init__(self, initial_share: tuple[str, list[int]], public_key: rsa.RSAPublicKey, formula: str,
                  new_formula: str,
                  format_version: int):
         self.creation_datetime = datetime.now()
         self.identifier = _generate_room_id()
-        self.participants_shares = [initial_share]
-        self.formula = formula
-        self.new_formula = new_formula
+        self.participants_shares = PackedShares([initial_share])
+        self.formula = sys.intern(formula)
+        self.new_formula = sys.intern(new_formula)
         self.format_version = format_version
         self.participants_new_shares = None
-        self._configuration = shamir_math_module.Configuration(modulo=CONFIGURATION_MODULO, formula=formula,
-                                                               version=format_version)
-        self._new_configuration = shamir_math_module.Configuration(modulo=CONFIGURATION_MODULO, formula=new_formula,
-                                                                   version=format_version)
-        self.participants_count = len(self._configuration.names())
         self.public_key = public_key
+        self._init_configurations()
+
+    def _init_configurations(self):
+        # Both configurations come from the per-process cache, the new one is parsed here to reject it up front
+        self.participants_count = len(_configuration(self.formula, self.format_version).names())
+        _configuration(self.new_formula, self.format_version)
+        self._attempted_shares_count = None
+        # Without an access structure reissue is attempted, at most once per new share
+        self._gate_counts, self._quorum_reached = _quorum_counts(self.formula, self.participants_shares)
 
     def add_share(self, name: str, share_values: list[int]):
-        if not (shamir_math_module.Part(name, share_values) in self.participants_shares):
-            self.participants_shares.append(shamir_math_module.Part(name, share_values))
-
-    def pop_share_by_user(self, user_id: str) -> shamir_math_module.Part:
-        def pop_share_by_user(self, user_id: str) -> list[int]:
-            for index, user in enumerate(self.participants_new_shares):
-                if user.name == user_id and user.values is not None:
-                    to_return = user.values
-                    self.participants_new_shares[index].values = None
-                    return to_return
-            raise Exception()
-
-    def try_reissue(self) -> bool:
+        if not self.participants_shares.add(name, share_values):
+            return
+        if self._gate_counts is not None and not self._quorum_reached:
+            self._quorum_reached = _access_structure(self.formula).add(self._gate_counts, name)
+
+    def pop_share_by_user(self, user_id: str) -> list[int]:
+        if not self.reissued:
+            raise ShareNotAvailableError(user_id)
+        return self.participants_new_shares.pop(user_id)
+
+    @property
+    def reissued(self) -> bool:
+        return self.participants_new_shares is not None
+
+    async def try_reissue(self) -> bool:
+        if self.reissued:
+            return 0
+        if self._quorum_reached is False:
+            return 1
+        shares_count = len(self.participants_shares)
+        if self._attempted_shares_count == shares_count:
+            return 1
         try:
-            self.participants_new_shares = self._configuration.modify(self._new_configuration, self.participants_shares)
-        except:
+            new_shares = await executor.COMPUTE_EXECUTOR.run(_reissue_shares, self.formula, self.new_formula,
+                                                             self.format_version,
+                                                             self.participants_shares.items(),
+                                                             timeout=REISSUE_TIMEOUT_SECONDS)
+        except (executor.ExecutorOverloadedError, executor.ExecutorTimeoutError):
+            raise
+        except Exception:
+            self._attempted_shares_count = shares_count
             return 1
+        self.participants_new_shares = PackedShares(new_shares)
         return 0
 
+    def progress(self) -> dict:
+        return {
+            'signed_count': len(self.participants_shares),
+            'participants_count': self.participants_count,
+            'quorum_reached': True if self.reissued else self._quorum_reached,
+            'room_status': 'reissued' if self.reissued else 'waiting_participants'
+        }
+
+    def stored_size(self) -> int:
+        size = self.participants_shares.nbytes()
+        if self.participants_new_shares is not None:
+            size += self.participants_new_shares.nbytes()
+        return size
+
+    def to_record(self) -> dict:
+        return {
+            'identifier': self.identifier,
+            'creation_datetime': self.creation_datetime.timestamp(),
+            'participants_shares': _encode_shares(self.participants_shares),
+            'formula': self.formula,
+            'new_formula': self.new_formula,
+            'participants_new_shares': None if self.participants_new_shares is None
+            else _encode_shares(self.participants_new_shares),
+            'format_version': self.format_version,
+            'public_key': _encode_public_key(self.public_key)
+        }
+
+    @classmethod
+    def from_record(cls, record: dict) -> "SecretReissueRoomStoredData":
+        room = cls.__new__(cls)
+        room.creation_datetime = datetime.fromtimestamp(record['creation_datetime'])
+        room.identifier = record['identifier']
+        room.participants_shares = _decode_shares(record['participants_shares'])
+        room.formula = sys.intern(record['formula'])
+        room.new_formula = sys.intern(record['new_formula'])
+        room.participants_new_shares = None if record['participants_new_shares'] is None \
+            else _decode_shares(record['participants_new_shares'])
+        room.format_version = record['format_version']
+        room.public_key = _decode_public_key(record['public_key'])
+        room._init_configurations()
+        return room
+
 
 class SecretReissueRoomsManager:
-    _stored_rooms: list[SecretReissueRoomStoredData]
+    _stored_rooms: RoomsStore | SharedRoomsStore
+    _locks: RoomsLocks
 
     def __init__(self):
-        self._stored_rooms = []
+        self._stored_rooms = _rooms_store("secret_reissue", SecretReissueRoomStoredData.from_record)
+        self._locks = _rooms_locks()
 
-    def create_room(self, initial_share_name: str, initial_share_value: int, public_n: int, public_e: int, formula: str,
-                    new_formula: str,
-                    format_version: int) -> str:
-        new_room = SecretReissueRoomStoredData(shamir_math_module.Part(initial_share_name, initial_share_value),
+    async def create_room(self, initial_share_name: str, initial_share_value: int, public_n: int, public_e: int,
+                          formula: str, new_formula: str, format_version: int) -> str:
+        new_room = SecretReissueRoomStoredData((initial_share_name, initial_share_value),
                                                rsa.RSAPublicNumbers(public_e, public_n).public_key(),
                                                formula, new_formula, format_version)
-        self._stored_rooms.append(new_room)
+        await self._stored_rooms.put(new_room)
         return new_room.identifier
 
     def get_room_stored_data(self, room_id: str) -> SecretReissueRoomStoredData:
-        for room in self._stored_rooms:
-            if room.identifier == room_id:
-                return room
-        raise Exception()
+        return self._stored_rooms.get(room_id)
+
+    async def save_room_stored_data(self, room: SecretReissueRoomStoredData):
+        await self._stored_rooms.update(room)
+
+    def room_lock(self, room_id: str):
+        return self._locks.hold(room_id)
+
+    def start(self):
+        self._stored_rooms.start()
+
+    async def stop(self):
+        await self._stored_rooms.stop()
+
+    def stats(self) -> dict:
+        return self._stored_rooms.stats()
@@ -0,0 +1,220 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+import asyncio
+import logging
+import sqlite3
+import json
+import os
+
+ROOMS_DATABASE_PATH = os.environ.get("SHAMIR_ROOMS_DATABASE")
+# More than one server process means rooms live in the database only, see RoomsStore.SharedRoomsStore
+SHARED_STATE = int(os.environ.get("SHAMIR_WORKERS", "1")) > 1
+WRITE_BEHIND_INTERVAL_SECONDS = float(os.environ.get("SHAMIR_WRITE_BEHIND_INTERVAL_SECONDS", "0.5"))
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rooms (
+    kind TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    record BLOB NOT NULL,
+    PRIMARY KEY (kind, room_id)
+) WITHOUT ROWID
+"""
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA busy_timeout=5000")
+    return connection
+
+
+def _log_write_failure(future: Future):
+    if future.exception() is not None:
+        logger.error("Failed to write to the rooms database", exc_info=future.exception())
+
+
+class RoomsDatabase:
+    # One SQLite file shared by every manager. Reads happen on the event loop through their own connection
+    # (single primary key lookups), writes are batched and applied by one background thread.
+    _path: str
+    _reader: sqlite3.Connection
+    _writer: sqlite3.Connection
+    _write_executor: ThreadPoolExecutor
+
+    def __init__(self, path: str):
+        self._path = path
+        self._reader = None
+        self._writer = None
+        self._write_executor = None
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def open(self):
+        if self._reader is None:
+            directory = os.path.dirname(os.path.abspath(self._path))
+            os.makedirs(directory, exist_ok=True)
+            self._writer = _connect(self._path)
+            self._writer.execute(_SCHEMA)
+            self._reader = _connect(self._path)
+            self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rooms-write-behind")
+
+    def close(self):
+        if self._reader is not None:
+            self._write_executor.shutdown(wait=True)
+            self._reader.close()
+            self._writer.close()
+            self._reader = None
+            self._writer = None
+            self._write_executor = None
+
+    def load_index(self, kind: str) -> list[tuple[str, float]]:
+        return self._reader.execute("SELECT room_id, created FROM rooms WHERE kind = ? ORDER BY created",
+                                    (kind,)).fetchall()
+
+    def load(self, kind: str, room_id: str) -> bytes:
+        row = self._reader.execute("SELECT record FROM rooms WHERE kind = ? AND room_id = ?",
+                                   (kind, room_id)).fetchone()
+        return row[0] if row is not None else None
+
+    def count(self, kind: str) -> int:
+        return self._reader.execute("SELECT COUNT(*) FROM rooms WHERE kind = ?", (kind,)).fetchone()[0]
+
+    def load_created_before(self, kind: str, created: float) -> list[tuple[str, bytes]]:
+        return self._reader.execute("SELECT room_id, record FROM rooms WHERE kind = ? AND created < ?",
+                                    (kind, created)).fetchall()
+
+    def _write(self, kind: str, room_id: str, created: float, record: bytes):
+        self._writer.execute("INSERT OR REPLACE INTO rooms (kind, room_id, created, record) VALUES (?, ?, ?, ?)",
+                             (kind, room_id, created, record))
+
+    def _update(self, kind: str, room_id: str, record: bytes):
+        self._writer.execute("UPDATE rooms SET record = ? WHERE kind = ? AND room_id = ?", (record, kind, room_id))
+
+    def _delete(self, kind: str, room_id: str):
+        self._writer.execute("DELETE FROM rooms WHERE kind = ? AND room_id = ?", (kind, room_id))
+
+    # Single writes also go through the writer thread: with other processes writing, a statement can wait up to
+    # busy_timeout for the database lock, which must not stall the event loop
+
+    async def write(self, kind: str, room_id: str, created: float, record: bytes):
+        await asyncio.get_running_loop().run_in_executor(self._write_executor, self._write, kind, room_id, created,
+                                                         record)
+
+    async def update(self, kind: str, room_id: str, record: bytes):
+        # Only rewrites a room that still exists
+        await asyncio.get_running_loop().run_in_executor(self._write_executor, self._update, kind, room_id, record)
+
+    def delete_soon(self, kind: str, room_id: str):
+        # Nothing waits for it: a room read again before the delete lands is found expired once more
+        self._write_executor.submit(self._delete, kind, room_id).add_done_callback(_log_write_failure)
+
+    def _write_batch(self, kind: str, upserts: list[tuple[str, float, bytes]], deletes: list[str]):
+        with self._writer:
+            self._writer.execute("BEGIN")
+            self._writer.executemany("INSERT OR REPLACE INTO rooms (kind, room_id, created, record) "
+                                     "VALUES (?, ?, ?, ?)",
+                                     [(kind, room_id, created, record) for room_id, created, record in upserts])
+            self._writer.executemany("DELETE FROM rooms WHERE kind = ? AND room_id = ?",
+                                     [(kind, room_id) for room_id in deletes])
+
+    async def write_batch(self, kind: str, upserts: list[tuple[str, float, bytes]], deletes: list[str]):
+        await asyncio.get_running_loop().run_in_executor(self._write_executor, self._write_batch, kind, upserts,
+                                                         deletes)
+
+
+class RoomsPersistence:
+    # Write-behind view of RoomsDatabase for one room kind. Rooms are expected to expose to_record()
+    _database: RoomsDatabase
+    _kind: str
+    _dirty: dict
+    _deleted: set[str]
+
+    def __init__(self, database: RoomsDatabase, kind: str, interval: float = WRITE_BEHIND_INTERVAL_SECONDS):
+        self._database = database
+        self._kind = kind
+        self._interval = interval
+        self._dirty = {}
+        self._deleted = set()
+        self._flusher_task = None
+        self._flushed_count = 0
+
+    def open(self) -> list[tuple[str, datetime]]:
+        self._database.open()
+        return [(room_id, datetime.fromtimestamp(created))
+                for room_id, created in self._database.load_index(self._kind)]
+
+    def load(self, room_id: str) -> dict:
+        if room_id in self._dirty:
+            return self._dirty[room_id].to_record()
+        if room_id in self._deleted:
+            return None
+        record = self._database.load(self._kind, room_id)
+        return json.loads(record) if record is not None else None
+
+    def mark_dirty(self, room):
+        self._deleted.discard(room.identifier)
+        self._dirty[room.identifier] = room
+
+    def delete(self, room_id: str):
+        self._dirty.pop(room_id, None)
+        self._deleted.add(room_id)
+
+    async def flush(self):
+        if not self._dirty and not self._deleted:
+            return
+        dirty, self._dirty = self._dirty, {}
+        deleted, self._deleted = self._deleted, set()
+        # Records are taken on the loop so they reflect one consistent state of each room
+        upserts = [(room_id, room.creation_datetime.timestamp(), json.dumps(room.to_record()).encode())
+                   for room_id, room in dirty.items()]
+        try:
+            await self._database.write_batch(self._kind, upserts, list(deleted))
+        except Exception:
+            logger.exception("Failed to persist %s rooms", self._kind)
+            for room_id, room in dirty.items():
+                self._dirty.setdefault(room_id, room)
+            self._deleted |= deleted - set(self._dirty)
+            return
+        self._flushed_count += len(upserts) + len(deleted)
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            await self.flush()
+
+    def start(self):
+        if self._flusher_task is None:
+            self._flusher_task = asyncio.get_running_loop().create_task(self._flush_forever())
+
+    async def stop(self):
+        if self._flusher_task is not None:
+            self._flusher_task.cancel()
+            try:
+                await self._flusher_task
+            except asyncio.CancelledError:
+                pass
+            self._flusher_task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'pending_writes': len(self._dirty) + len(self._deleted),
+            'flushed_writes': self._flushed_count
+        }
+
+
+DATABASE = RoomsDatabase(ROOMS_DATABASE_PATH) if ROOMS_DATABASE_PATH else None
+if SHARED_STATE and DATABASE is None:
+    raise RuntimeError("Running more than one worker requires SHAMIR_ROOMS_DATABASE")
+
+
+def persistence_for(kind: str) -> RoomsPersistence:
+    if DATABASE is None:
+        return None
+    return RoomsPersistence(DATABASE, kind)
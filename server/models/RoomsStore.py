@@ -0,0 +1,267 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable
+from server.models.RoomsPersistence import RoomsDatabase, RoomsPersistence
+import asyncio
+import json
+import os
+
+ROOM_TTL_SECONDS = int(os.environ.get("SHAMIR_ROOM_TTL_SECONDS", str(24 * 60 * 60)))
+ROOMS_MAX_COUNT = int(os.environ.get("SHAMIR_ROOMS_MAX_COUNT", "100000"))
+ROOMS_MAX_BYTES = int(os.environ.get("SHAMIR_ROOMS_MAX_BYTES", str(1024 * 1024 * 1024)))
+SWEEP_INTERVAL_SECONDS = 60
+
+EVICTION_EXPIRED = "expired"
+EVICTION_ROOMS_LIMIT = "rooms_limit"
+EVICTION_BYTES_LIMIT = "bytes_limit"
+
+
+class RoomNotFoundError(Exception):
+    pass
+
+
+class RoomsStore:
+    # Rooms are expected to expose identifier, creation_datetime and stored_size(). With a persistence backend the
+    # room and byte budgets only bound what is kept in memory: rooms over budget are unloaded and read back on the
+    # next access, only expiry removes them for good.
+    _rooms: OrderedDict
+    _by_creation: dict[str, datetime]
+    _sizes: dict[str, int]
+    _total_bytes: int
+    _persistence: RoomsPersistence
+
+    def __init__(self, ttl_seconds: int = ROOM_TTL_SECONDS, max_rooms: int = ROOMS_MAX_COUNT,
+                 max_bytes: int = ROOMS_MAX_BYTES, on_evict: Callable = None, persistence: RoomsPersistence = None,
+                 load_room: Callable[[dict], object] = None):
+        self._rooms = OrderedDict()  # loaded rooms, least recently used first
+        self._by_creation = {}  # every known room, insertion order is creation order so expired rooms are in front
+        self._sizes = {}
+        self._total_bytes = 0
+        self._ttl = timedelta(seconds=ttl_seconds)
+        self._max_rooms = max_rooms
+        self._max_bytes = max_bytes
+        self._on_evict = on_evict
+        self._persistence = persistence
+        self._load_room = load_room
+        self._evictions = {EVICTION_EXPIRED: 0, EVICTION_ROOMS_LIMIT: 0, EVICTION_BYTES_LIMIT: 0}
+        self._loads_count = 0
+        self._sweeper_task = None
+
+    def __len__(self) -> int:
+        return len(self._by_creation)
+
+    def __contains__(self, room_id: str) -> bool:
+        return room_id in self._by_creation
+
+    def _is_expired(self, room_id: str, now: datetime) -> bool:
+        return now - self._by_creation[room_id] > self._ttl
+
+    def _keep_loaded(self, room):
+        room_id = room.identifier
+        self._rooms[room_id] = room
+        self._rooms.move_to_end(room_id)
+        size = room.stored_size()
+        self._total_bytes += size - self._sizes.get(room_id, 0)
+        self._sizes[room_id] = size
+        self._enforce_limits(room_id)
+
+    async def put(self, room):
+        # Coroutines like SharedRoomsStore.put, nothing is awaited in memory
+        if room.identifier not in self._by_creation:
+            self._by_creation[room.identifier] = room.creation_datetime
+        if self._persistence is not None:
+            self._persistence.mark_dirty(room)
+        self._keep_loaded(room)
+
+    async def update(self, room):
+        # Rooms expired while a request was still working on them stay expired
+        if room.identifier in self._by_creation:
+            await self.put(room)
+
+    def _load(self, room_id: str):
+        record = self._persistence.load(room_id) if self._persistence is not None else None
+        if record is None:
+            return None
+        self._loads_count += 1
+        return self._load_room(record)
+
+    def get(self, room_id: str):
+        if room_id not in self._by_creation:
+            raise RoomNotFoundError()
+        if self._is_expired(room_id, datetime.now()):
+            self._expire(room_id)
+            raise RoomNotFoundError()
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._load(room_id)
+            if room is None:
+                del self._by_creation[room_id]
+                raise RoomNotFoundError()
+            self._keep_loaded(room)
+        else:
+            self._rooms.move_to_end(room_id)
+        return room
+
+    def _unload(self, room_id: str):
+        room = self._rooms.pop(room_id)
+        self._total_bytes -= self._sizes.pop(room_id)
+        return room
+
+    def _expire(self, room_id: str):
+        room = self._unload(room_id) if room_id in self._rooms else self._load(room_id)
+        del self._by_creation[room_id]
+        if self._persistence is not None:
+            self._persistence.delete(room_id)
+        self._evictions[EVICTION_EXPIRED] += 1
+        if room is not None and self._on_evict is not None:
+            self._on_evict(room)
+
+    def _evict(self, room_id: str, reason: str):
+        room = self._unload(room_id)
+        self._evictions[reason] += 1
+        if self._persistence is not None:
+            return
+        del self._by_creation[room_id]
+        if self._on_evict is not None:
+            self._on_evict(room)
+
+    def _enforce_limits(self, keep_room_id: str):
+        # The room that was just stored is evicted last, and never for the bytes budget alone
+        while len(self._rooms) > self._max_rooms:
+            self._evict(self._least_recent_except(keep_room_id), EVICTION_ROOMS_LIMIT)
+        while self._total_bytes > self._max_bytes and len(self._rooms) > 1:
+            self._evict(self._least_recent_except(keep_room_id), EVICTION_BYTES_LIMIT)
+
+    def _least_recent_except(self, room_id: str) -> str:
+        for candidate in self._rooms:
+            if candidate != room_id:
+                return candidate
+        return room_id
+
+    def sweep(self) -> int:
+        now = datetime.now()
+        expired = []
+        for room_id in self._by_creation:
+            if not self._is_expired(room_id, now):
+                break
+            expired.append(room_id)
+        for room_id in expired:
+            self._expire(room_id)
+        return len(expired)
+
+    async def _sweep_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def start(self, interval: float = SWEEP_INTERVAL_SECONDS):
+        if self._persistence is not None and not self._by_creation:
+            # Only identifiers and creation times are read here, room records are loaded on first access
+            for room_id, creation_datetime in self._persistence.open():
+                self._by_creation[room_id] = creation_datetime
+            self._persistence.start()
+        if self._sweeper_task is None:
+            self._sweeper_task = asyncio.get_running_loop().create_task(self._sweep_forever(interval))
+
+    async def stop(self):
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+            try:
+                await self._sweeper_task
+            except asyncio.CancelledError:
+                pass
+            self._sweeper_task = None
+        if self._persistence is not None:
+            await self._persistence.stop()
+
+    def stats(self) -> dict:
+        stats = {
+            'live_rooms': len(self._by_creation),
+            'loaded_rooms': len(self._rooms),
+            'stored_bytes': self._total_bytes,
+            'max_rooms': self._max_rooms,
+            'max_bytes': self._max_bytes,
+            'ttl_seconds': int(self._ttl.total_seconds()),
+            'evictions': dict(self._evictions),
+            'loads': self._loads_count
+        }
+        if self._persistence is not None:
+            stats['persistence'] = self._persistence.stats()
+        return stats
+
+
+class SharedRoomsStore:
+    # Used when several server processes serve the same rooms: nothing is cached, every access reads the room from
+    # the shared database and every change is written through at once. Callers serialise changes to one room with
+    # RoomsLocks.RoomsLocks.
+    _database: RoomsDatabase
+    _kind: str
+
+    def __init__(self, database: RoomsDatabase, kind: str, load_room: Callable[[dict], object],
+                 ttl_seconds: int = ROOM_TTL_SECONDS, on_evict: Callable = None):
+        self._database = database
+        self._kind = kind
+        self._load_room = load_room
+        self._ttl = timedelta(seconds=ttl_seconds)
+        self._on_evict = on_evict
+        self._expired_count = 0
+        self._sweeper_task = None
+
+    def __contains__(self, room_id: str) -> bool:
+        return self._database.load(self._kind, room_id) is not None
+
+    async def put(self, room):
+        await self._database.write(self._kind, room.identifier, room.creation_datetime.timestamp(),
+                                   json.dumps(room.to_record()).encode())
+
+    async def update(self, room):
+        await self._database.update(self._kind, room.identifier, json.dumps(room.to_record()).encode())
+
+    def get(self, room_id: str):
+        record = self._database.load(self._kind, room_id)
+        if record is None:
+            raise RoomNotFoundError()
+        room = self._load_room(json.loads(record))
+        if datetime.now() - room.creation_datetime > self._ttl:
+            self._expire(room_id, room)
+            raise RoomNotFoundError()
+        return room
+
+    def _expire(self, room_id: str, room):
+        self._database.delete_soon(self._kind, room_id)
+        self._expired_count += 1
+        if self._on_evict is not None:
+            self._on_evict(room)
+
+    def sweep(self) -> int:
+        cutoff = (datetime.now() - self._ttl).timestamp()
+        expired = self._database.load_created_before(self._kind, cutoff)
+        for room_id, record in expired:
+            self._expire(room_id, self._load_room(json.loads(record)))
+        return len(expired)
+
+    async def _sweep_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def start(self, interval: float = SWEEP_INTERVAL_SECONDS):
+        self._database.open()
+        if self._sweeper_task is None:
+            self._sweeper_task = asyncio.get_running_loop().create_task(self._sweep_forever(interval))
+
+    async def stop(self):
+        if self._sweeper_task is not None:
+            self._sweeper_task.cancel()
+            try:
+                await self._sweeper_task
+            except asyncio.CancelledError:
+                pass
+            self._sweeper_task = None
+
+    def stats(self) -> dict:
+        return {
+            'live_rooms': self._database.count(self._kind),
+            'ttl_seconds': int(self._ttl.total_seconds()),
+            'evictions': {EVICTION_EXPIRED: self._expired_count}
+        }
@@ -1,30 +1,212 @@
 import aiohttp
 from aiohttp import web
+from multidict import CIMultiDict
+from cryptography.exceptions import InvalidSignature
+from typing import Awaitable, Callable
 from server.models import RoomsManagers
+from server.models import RoomsPersistence
+from server.models import RoomsEvents
+from server.models.RoomsStore import RoomNotFoundError
 from server.utils import utils
+from server.utils import executor
+from server.utils import key_pool
+from server.utils import document_store
+from server.utils import share_format
+from server.utils import verification_cache
+from server.utils import metrics
+from server.utils import admission
+from server.utils import share_archive
+from server.utils import startup
+from server.utils import errors
+from collections import deque
+import asyncio
 import json
+import logging
+import os
+
+
+PROVISION_MAX_ROOMS = int(os.environ.get("SHAMIR_PROVISION_MAX_ROOMS", "10000"))
+PROVISION_PIPELINE_DEPTH = int(os.environ.get("SHAMIR_PROVISION_PIPELINE_DEPTH",
+                                              str(executor.EXECUTOR_WORKERS + key_pool.KEY_POOL_WORKERS)))
+BULK_VERIFY_CONCURRENCY = int(os.environ.get("SHAMIR_BULK_VERIFY_CONCURRENCY", str(executor.EXECUTOR_WORKERS)))
+VERIFY_TIMEOUT_SECONDS = float(os.environ.get("SHAMIR_VERIFY_TIMEOUT_SECONDS", "60"))
+# Subscriptions re-read their room this often; with shared state that is how changes made by other worker
+# processes reach them, otherwise it only detects rooms that are gone and keeps the connection alive
+EVENTS_REFRESH_SECONDS = float(os.environ.get("SHAMIR_EVENTS_REFRESH_SECONDS",
+                                              "1" if RoomsPersistence.SHARED_STATE else "15"))
+SIGNING_ROOM_EVENTS = {'quorum_reached': 'enough_participants', 'document_signed': 'signed_document_link'}
+SECRET_REISSUE_ROOM_EVENTS = {'quorum_reached': 'quorum_reached', 'reissue_complete': 'links'}
+CONDITIONAL_HEADERS = (aiohttp.hdrs.IF_MATCH, aiohttp.hdrs.IF_NONE_MATCH, aiohttp.hdrs.IF_MODIFIED_SINCE,
+                       aiohttp.hdrs.IF_UNMODIFIED_SINCE, aiohttp.hdrs.IF_RANGE)
+WARM_UP_POLL_SECONDS = 0.1
+# Starting the worker processes and their imports on a cold machine
+WARM_UP_TIMEOUT_SECONDS = float(os.environ.get("SHAMIR_WARM_UP_TIMEOUT_SECONDS", "300"))
+WARM_UP_TASKS: list[asyncio.Task] = []
+
+logger = logging.getLogger(__name__)
+
+
+def _etag_matches(header_value: str, etag: str) -> bool:
+    for candidate in header_value.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+class DocumentFileResponse(web.FileResponse):
+    # Stored documents are immutable and identified by their SHA-256, so validators are evaluated here against the
+    # digest and aiohttp is only left with sendfile and Range handling
+    def __init__(self, document: document_store.StoredDocument, headers: dict):
+        super().__init__(document.path, headers=headers)
+        self._document_etag = document.sha256
+        self.etag = document.sha256
+
+    @property
+    def etag(self):
+        return web.FileResponse.etag.fget(self)
+
+    @etag.setter
+    def etag(self, value):
+        web.FileResponse.etag.fset(self, self._document_etag)
+
+    async def prepare(self, request):
+        headers = CIMultiDict(request.headers)
+        if_range = headers.get(aiohttp.hdrs.IF_RANGE)
+        if if_range is not None and if_range.strip() != f'"{self._document_etag}"':
+            headers.popall(aiohttp.hdrs.RANGE, None)
+        for header in CONDITIONAL_HEADERS:
+            headers.popall(header, None)
+        return await super().prepare(request.clone(headers=headers))
+
+
+def _document_response(request, document: document_store.StoredDocument, name: str) -> web.StreamResponse:
+    etag = f'"{document.sha256}"'
+    if_none_match = request.headers.get(aiohttp.hdrs.IF_NONE_MATCH)
+    if if_none_match is not None and _etag_matches(if_none_match, etag):
+        return web.Response(status=304, headers={'ETag': etag})
+    if_match = request.headers.get(aiohttp.hdrs.IF_MATCH)
+    if if_match is not None and not _etag_matches(if_match, etag):
+        return web.Response(status=412)
+    resp_headers = {'Content-Type': 'application/pdf',
+                    'Content-Disposition': f'attachment; filename="{name}"',
+                    'Cache-Control': 'private, no-cache'}
+    return DocumentFileResponse(document, resp_headers)
+
+
+def _share_file_fields(room_stored_data, user_id: str, share_values: list[int], formula: str) -> dict:
+    public_numbers = room_stored_data.public_key.public_numbers()
+    return {
+        "format_version": room_stored_data.format_version,
+        "name": user_id,
+        "share_values": share_values,
+        'public_key':
+            {
+                'n': str(public_numbers.n),
+                'e': str(public_numbers.e)
+            },
+        "formula": formula
+    }
+
+
+def _secret_room_formula(data: dict) -> str:
+    schema_type = data["type"]
+    participants = data["names"]
+    formula = None
+    if schema_type == "threshold":
+        threshold = int(data["threshold"])
+        participants_string = ""
+        for index, participant in enumerate(participants):
+            participants_string += str(participant)
+            if index != len(participants) - 1:
+                participants_string += ','
+        formula = f"T{threshold}({participants_string})"
+    elif schema_type == "formula":
+        formula = data["formula"]
+    return formula
+
+
+def _group_by_room(items: list[dict]) -> dict[str, list[dict]]:
+    grouped = {}
+    for item in items:
+        grouped.setdefault(item['room_id'], []).append(item)
+    return grouped
+
+
+async def _share_archive_response(request: web.Request) -> web.StreamResponse:
+    response = web.StreamResponse(headers={'Content-Type': share_archive.CONTENT_TYPE,
+                                           'Content-Disposition': 'attachment; filename="shares.zip"',
+                                           'Vary': 'Accept'})
+    await response.prepare(request)
+    return response
+
+
+def _sse_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def _publish_changes(events: RoomsEvents.RoomsEvents, room_id: str, before: dict, after: dict,
+                     transitions: dict[str, str]):
+    # before is None when nobody was subscribed to the room as the change started
+    if before is None or before == after:
+        return
+    events.publish(room_id, 'status', after)
+    for event, key in transitions.items():
+        if after[key] and not before[key]:
+            events.publish(room_id, event, after)
+
+
+async def _room_events_response(request, events: RoomsEvents.RoomsEvents, room_id: str,
+                                load_status: Callable[[], Awaitable[dict]]) -> web.StreamResponse:
+    status = await load_status()
+    with events.subscription(room_id) as queue:
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        await response.write(_sse_event('status', status))
+        while True:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), EVENTS_REFRESH_SECONDS)
+            except asyncio.TimeoutError:
+                try:
+                    current_status = await load_status()
+                except RoomNotFoundError:
+                    await response.write(_sse_event('room_closed', {'room_id': room_id}))
+                    break
+                if current_status != status:
+                    status = current_status
+                    await response.write(_sse_event('status', status))
+                else:
+                    await response.write(b": keepalive\n\n")
+                continue
+            if event == 'status':
+                status = data
+            await response.write(_sse_event(event, data))
+        await response.write_eof()
+    return response
 
 
 class APISecretCreationHandler:
     def __init__(self):
         self._rooms_manager = RoomsManagers.SecretCreationRoomsManager()
+        self._events = RoomsEvents.RoomsEvents()
+
+    def start(self):
+        self._rooms_manager.start()
+
+    async def stop(self):
+        await self._rooms_manager.stop()
+
+    def rooms_stats(self) -> dict:
+        return {**self._rooms_manager.stats(), 'subscriptions': self._events.stats()}
+
+    async def _subscribed_status(self, room) -> dict:
+        if not self._events.has_subscribers(room.identifier):
+            return None
+        return await self._room_status(room)
 
     async def create_secret_room(self, request):
         data = await request.json()
-        schema_type = data["type"]
-        participants = data["names"]
-        formula = None
-        if schema_type == "threshold":
-            threshold = int(data["threshold"])
-            participants_string = ""
-            for index, participant in enumerate(participants):
-                participants_string += str(participant)
-                if index != len(participants) - 1:
-                    participants_string += ','
-            formula = f"T{threshold}({participants_string})"
-        elif schema_type == "formula":
-            formula = data["formula"]
-        room_id = self._rooms_manager.create_room(participants, formula)
+        room_id = await self._rooms_manager.create_room(data["names"], _secret_room_formula(data))
         room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
         public_numbers = room_stored_data.public_key.public_numbers()
         return web.json_response({'room_id': room_id,
@@ -35,213 +217,431 @@ class APISecretCreationHandler:
                                       }
                                   })
 
-    async def get_secret_room(self, request):
-        room_id = request.rel_url.query['room_id']
-        room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
+    async def _room_status(self, room_stored_data) -> dict:
         public_numbers = room_stored_data.public_key.public_numbers()
         links_dict = {}
-        for share in room_stored_data.participants_shares:
-            if share.values is not None:
-                links_dict[share.name] = f"/downloadSecretShare/{room_id}/{share.name}"
+        for name in room_stored_data.participants_shares:
+            if room_stored_data.participants_shares.available(name):
+                links_dict[name] = f"/downloadSecretShare/{room_stored_data.identifier}/{name}"
             else:
-                links_dict[share.name] = None
-        return web.json_response({'links': links_dict,
-                                  'public_key':
-                                      {
-                                          'n': str(public_numbers.n),
-                                          'e': str(public_numbers.e)
-                                      }
-                                  })
+                links_dict[name] = None
+        return {'links': links_dict,
+                'public_key':
+                    {
+                        'n': str(public_numbers.n),
+                        'e': str(public_numbers.e)
+                    }
+                }
+
+    async def get_secret_room(self, request):
+        room_id = request.rel_url.query['room_id']
+        room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
+        return web.json_response(await self._room_status(room_stored_data))
+
+    async def subscribe_secret_room(self, request):
+        room_id = request.rel_url.query['room_id']
+
+        async def load_status():
+            return await self._room_status(self._rooms_manager.get_room_stored_data(room_id))
+        return await _room_events_response(request, self._events, room_id, load_status)
 
     async def download_secret_share(self, request):
         room_id = request.match_info['room_id']
         user_id = request.match_info['user_id']
-        room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
-        popped_share = room_stored_data.pop_share_by_user(user_id)
-        public_numbers = room_stored_data.public_key.public_numbers()
-        file_fields = {
-            "format_version": room_stored_data.format_version,
-            "name": user_id,
-            "share_values": popped_share,
-            'public_key':
-                {
-                    'n': str(public_numbers.n),
-                    'e': str(public_numbers.e)
-                },
-            "formula": room_stored_data.formula
-        }
-        json_string = json.dumps(file_fields)
-        json_bytes = str.encode(json_string)
-        resp_headers = {'Content-Type': 'application/octet-stream',
-                        'Content-Disposition': f'attachment; filename="{room_stored_data.identifier}.sss"'}
-        return web.Response(body=json_bytes, headers=resp_headers)
+        async with self._rooms_manager.room_lock(room_id):
+            room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
+            status = await self._subscribed_status(room_stored_data)
+            popped_share = room_stored_data.pop_share_by_user(user_id)
+            await self._rooms_manager.save_room_stored_data(room_stored_data)
+            _publish_changes(self._events, room_id, status, await self._subscribed_status(room_stored_data), {})
+        file_fields = _share_file_fields(room_stored_data, user_id, popped_share, room_stored_data.formula)
+        return share_format.share_response(request, file_fields, f"{room_stored_data.identifier}.sss")
+
+    async def batch_download_secret_shares(self, request):
+        data = await request.json()
+        shares = []
+        for room_id, items in _group_by_room(data['requests']).items():
+            try:
+                async with self._rooms_manager.room_lock(room_id):
+                    room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
+                    status = await self._subscribed_status(room_stored_data)
+                    for item in items:
+                        try:
+                            popped_share = room_stored_data.pop_share_by_user(item['user_id'])
+                        except Exception:
+                            shares.append({'room_id': room_id, 'user_id': item['user_id'], 'status': 'ERROR'})
+                            continue
+                        shares.append({'room_id': room_id, 'user_id': item['user_id'], 'status': 'OK',
+                                       'file': _share_file_fields(room_stored_data, item['user_id'], popped_share,
+                                                                  room_stored_data.formula)})
+                    await self._rooms_manager.save_room_stored_data(room_stored_data)
+                    _publish_changes(self._events, room_id, status, await self._subscribed_status(room_stored_data),
+                                     {})
+            except Exception:
+                shares.extend({'room_id': room_id, 'user_id': item['user_id'], 'status': 'ERROR'} for item in items)
+        return web.json_response({'shares': shares})
+
+    async def _provision_room(self, data: dict,
+                              participant: str) -> (RoomsManagers.SecretCreationRoomStoredData, list[int]):
+        room_id = await self._rooms_manager.create_room(data["names"], _secret_room_formula(data))
+        async with self._rooms_manager.room_lock(room_id):
+            room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
+            if participant is None or participant not in room_stored_data.participants_shares:
+                return room_stored_data, None
+            share_values = room_stored_data.pop_share_by_user(participant)
+            await self._rooms_manager.save_room_stored_data(room_stored_data)
+        return room_stored_data, share_values
+
+    async def provision_secret_rooms(self, request):
+        # Creates every room of {'rooms': [<createSecretRoom body>, ...]} and streams back a zip with the share of
+        # ?participant=<name> in each room as <name>/<room_id>.sss, handed out like downloadSecretShare does, and
+        # rooms.json listing the created room ids (null for a room that failed). Only that participant's shares are
+        # in the archive, one response never holds a quorum: everyone else fetches theirs from /downloadShareArchive.
+        # Rooms are created at most PROVISION_PIPELINE_DEPTH ahead of the one being written, so key generation and
+        # splitting keep the workers busy while memory stays bounded however many rooms are requested.
+        rooms = (await request.json())['rooms']
+        participant = request.rel_url.query.get('participant')
+        if len(rooms) > PROVISION_MAX_ROOMS:
+            return errors.error_response(413, f"At most {PROVISION_MAX_ROOMS} rooms can be provisioned at once")
+        response = await _share_archive_response(request)
+        archive = share_archive.ShareArchive(response)
+        room_ids = []
+        pending = deque()
+        try:
+            for index, data in enumerate(rooms):
+                pending.append((index, asyncio.ensure_future(self._provision_room(data, participant))))
+                if len(pending) >= PROVISION_PIPELINE_DEPTH:
+                    room_ids.append(await self._archive_room(request, archive, participant, *pending.popleft()))
+            while pending:
+                room_ids.append(await self._archive_room(request, archive, participant, *pending.popleft()))
+            await archive.add("rooms.json", json.dumps(room_ids).encode())
+            await archive.close()
+        finally:
+            for _, task in pending:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+        await response.write_eof()
+        return response
+
+    async def _archive_room(self, request, archive: share_archive.ShareArchive, participant: str, index: int,
+                            provisioning: asyncio.Future) -> str:
+        # The response is already streaming, a room that failed is reported as an entry of its own
+        try:
+            room_stored_data, share_values = await provisioning
+        except Exception:
+            await archive.add(f"errors/{index}.json", json.dumps({'index': index, 'status': 'ERROR'}).encode())
+            return None
+        if share_values is not None:
+            body, _ = share_format.share_file(request, _share_file_fields(room_stored_data, participant, share_values,
+                                                                          room_stored_data.formula))
+            await archive.add(f"{participant}/{room_stored_data.identifier}.sss", body)
+        return room_stored_data.identifier
+
+    async def download_share_archive(self, request):
+        # {'participant': <name>, 'room_ids': [...]} streams a zip with the participant's share of each room as
+        # <name>/<room_id>.sss, handed out like downloadSecretShare does. A room without a share left for them is
+        # reported as errors/<index>.json.
+        data = await request.json()
+        participant = data['participant']
+        if len(data['room_ids']) > PROVISION_MAX_ROOMS:
+            return errors.error_response(413, f"At most {PROVISION_MAX_ROOMS} rooms can be downloaded at once")
+        response = await _share_archive_response(request)
+        archive = share_archive.ShareArchive(response)
+        for index, room_id in enumerate(data['room_ids']):
+            try:
+                async with self._rooms_manager.room_lock(room_id):
+                    room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
+                    status = await self._subscribed_status(room_stored_data)
+                    share_values = room_stored_data.pop_share_by_user(participant)
+                    await self._rooms_manager.save_room_stored_data(room_stored_data)
+                    _publish_changes(self._events, room_id, status, await self._subscribed_status(room_stored_data),
+                                     {})
+            except Exception:
+                await archive.add(f"errors/{index}.json", json.dumps({'index': index, 'status': 'ERROR'}).encode())
+                continue
+            body, _ = share_format.share_file(request, _share_file_fields(room_stored_data, participant, share_values,
+                                                                          room_stored_data.formula))
+            await archive.add(f"{participant}/{room_stored_data.identifier}.sss", body)
+        await archive.close()
+        await response.write_eof()
+        return response
+
+    def key_pool_stats(self) -> dict:
+        return self._rooms_manager.key_pool.stats()
+
+    async def get_key_pool_stats(self, request):
+        return web.json_response(self.key_pool_stats())
 
     async def download_public_key(self, request):
         room_id = request.match_info['room_id']
         room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
         public_numbers = room_stored_data.public_key.public_numbers()
-        file_fields = {
-            'n': str(public_numbers.n),
-            'e': str(public_numbers.e)
-        }
-        json_string = json.dumps(file_fields)
-        json_bytes = str.encode(json_string)
-        resp_headers = {'Content-Type': 'application/octet-stream',
-                        'Content-Disposition': f'attachment; filename="{room_stored_data.identifier}.rpk"'}
-        return web.Response(body=json_bytes, headers=resp_headers)
+        return share_format.public_key_response(request, public_numbers.n, public_numbers.e,
+                                                f"{room_stored_data.identifier}.rpk")
 
 
 class APIDocumentSigningHandler:
     def __init__(self):
         self._rooms_manager = RoomsManagers.DocumentSigningRoomsManager()
+        self._events = RoomsEvents.RoomsEvents()
+
+    def start(self):
+        self._rooms_manager.start()
+
+    async def stop(self):
+        await self._rooms_manager.stop()
+
+    def rooms_stats(self) -> dict:
+        return {**self._rooms_manager.stats(), 'subscriptions': self._events.stats()}
+
+    async def _subscribed_status(self, room) -> dict:
+        if not self._events.has_subscribers(room.identifier):
+            return None
+        return await self._room_status(room)
 
     async def create_signing_room(self, request):
         multipart = await request.multipart()
-        pdf_binary = None
+        pdf_document = None
         pdf_name = "document.pdf"
         secret_part_binary = None
-        while True:
-            part = await multipart.next()
-            if part is None:
-                break
-            if part.headers[aiohttp.hdrs.CONTENT_TYPE] == 'application/pdf':
-                pdf_binary = bytes(await part.read())
-                if part.filename is not None:
-                    pdf_name = part.filename
-            elif part.headers[aiohttp.hdrs.CONTENT_TYPE] == 'application/octet-stream':
-                secret_part_binary = bytes(await part.read())
-
-        json_string = secret_part_binary.decode()
-        json_object = json.loads(json_string)
-        room_id, creator_token = self._rooms_manager.create_room(json_object['name'], json_object['share_values'],
-                                                                 int(json_object['public_key']['n']),
-                                                                 int(json_object['public_key']['e']),
-                                                                 json_object['formula'], pdf_binary, pdf_name,
-                                                                 json_object['format_version'])
+        try:
+            while True:
+                part = await multipart.next()
+                if part is None:
+                    break
+                if part.headers[aiohttp.hdrs.CONTENT_TYPE] == 'application/pdf':
+                    pdf_document = await document_store.DOCUMENT_STORE.save_part(part)
+                    if part.filename is not None:
+                        pdf_name = part.filename
+                elif part.headers[aiohttp.hdrs.CONTENT_TYPE] == 'application/octet-stream':
+                    secret_part_binary = bytes(await part.read())
+
+            json_object = share_format.decode_share(secret_part_binary)
+            room_id, creator_token = await self._rooms_manager.create_room(json_object['name'],
+                                                                           json_object['share_values'],
+                                                                           json_object['public_key']['n'],
+                                                                           json_object['public_key']['e'],
+                                                                           json_object['formula'], pdf_document,
+                                                                           pdf_name, json_object['format_version'])
+        except BaseException:
+            if pdf_document is not None:
+                pdf_document.discard()
+            raise
         return web.json_response({'room_id': room_id,
                                   'creator_token': creator_token
                                   })
 
+    async def _room_status(self, room_stored_data) -> dict:
+        room_id = room_stored_data.identifier
+        return {
+            'signed_count': len(room_stored_data.participants_shares),
+            'participants_count': room_stored_data.participants_count,
+            'enough_participants': await room_stored_data.signing_available(),
+            'original_document_link': f'/downloadOriginalDocument/{room_id}',
+            'signed_document_link': None if room_stored_data.signed_pdf_document is None
+            else f'/downloadSignedDocument/{room_id}'
+        }
+
     async def get_signing_room(self, request):
         room_id = request.rel_url.query['room_id']
         room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
-        return web.json_response({
-            'signed_count': len(room_stored_data.participants_shares),
-            'participants_count': room_stored_data.participants_count,
-            'enough_participants': room_stored_data.signing_available(),
-            'original_document_link': f'/downloadOriginalDocument/{room_id}'
-        })
+        return web.json_response(await self._room_status(room_stored_data))
+
+    async def subscribe_signing_room(self, request):
+        room_id = request.rel_url.query['room_id']
+
+        async def load_status():
+            return await self._room_status(self._rooms_manager.get_room_stored_data(room_id))
+        return await _room_events_response(request, self._events, room_id, load_status)
 
     async def download_original_document(self, request):
         room_id = request.match_info['room_id']
         room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
-        resp_headers = {'Content-Type': 'application/pdf',
-                        'Content-Disposition': f'attachment; filename="{room_stored_data.pdf_name}"'}
-        return web.Response(body=room_stored_data.pdf_binary, headers=resp_headers)
+        return _document_response(request, room_stored_data.pdf_document, room_stored_data.pdf_name)
 
     async def sign_document(self, request):
         room_id = request.rel_url.query['room_id']
-        share_binary = await request.read()
-        json_string = share_binary.decode()
-        json_object = json.loads(json_string)
-        room = self._rooms_manager.get_room_stored_data(room_id)
-        room.add_share(json_object['name'], json_object['share_values'])
+        json_object = share_format.decode_share(await request.read())
+        async with self._rooms_manager.room_lock(room_id):
+            room = self._rooms_manager.get_room_stored_data(room_id)
+            status = await self._subscribed_status(room)
+            room.add_share(json_object['name'], json_object['share_values'])
+            await self._rooms_manager.save_room_stored_data(room)
+            _publish_changes(self._events, room_id, status, await self._subscribed_status(room), SIGNING_ROOM_EVENTS)
         return web.Response(status=200)
 
+    async def batch_sign_document(self, request):
+        data = await request.json()
+        rooms = {}
+        for room_id, items in _group_by_room(data['shares']).items():
+            try:
+                async with self._rooms_manager.room_lock(room_id):
+                    room = self._rooms_manager.get_room_stored_data(room_id)
+                    status = await self._subscribed_status(room)
+                    for item in items:
+                        room.add_share(item['share']['name'], item['share']['share_values'])
+                    await self._rooms_manager.save_room_stored_data(room)
+                    _publish_changes(self._events, room_id, status, await self._subscribed_status(room),
+                                     SIGNING_ROOM_EVENTS)
+                    rooms[room_id] = {'status': 'OK',
+                                      'signed_count': len(room.participants_shares),
+                                      'enough_participants': await room.signing_available()}
+            except Exception:
+                rooms[room_id] = {'status': 'ERROR'}
+        return web.json_response({'rooms': rooms})
+
     async def finish_signing(self, request):
         room_id = request.rel_url.query['room_id']
         creator_token = request.rel_url.query['creator_token']
-        room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
-        if room_stored_data.finish_signing(creator_token):
+        status = await self._subscribed_status(self._rooms_manager.get_room_stored_data(room_id))
+        room_stored_data, signed_now = await self._rooms_manager.finish_signing(room_id, creator_token)
+        if room_stored_data is None:
             return web.Response(status=400)
-        resp_headers = {'Content-Type': 'application/pdf',
-                        'Content-Disposition': f'attachment; filename="{room_stored_data.pdf_name}"'}
-        return web.Response(body=room_stored_data.signed_pdf_binary, headers=resp_headers)
+        if signed_now:
+            _publish_changes(self._events, room_id, status, await self._subscribed_status(room_stored_data),
+                             SIGNING_ROOM_EVENTS)
+        return _document_response(request, room_stored_data.signed_pdf_document, room_stored_data.pdf_name)
 
     async def download_signed_document(self, request):
         room_id = request.match_info['room_id']
         room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
-        resp_headers = {'Content-Type': 'application/pdf',
-                        'Content-Disposition': f'attachment; filename="{room_stored_data.pdf_name}"'}
-        return web.Response(body=room_stored_data.signed_pdf_binary, headers=resp_headers)
+        if room_stored_data.signed_pdf_document is None:
+            return web.Response(status=404)
+        return _document_response(request, room_stored_data.signed_pdf_document, room_stored_data.pdf_name)
 
 
 class APISecretReissueHandler:
     def __init__(self):
         self._rooms_manager = RoomsManagers.SecretReissueRoomsManager()
+        self._events = RoomsEvents.RoomsEvents()
+
+    def start(self):
+        self._rooms_manager.start()
+
+    async def stop(self):
+        await self._rooms_manager.stop()
+
+    def rooms_stats(self) -> dict:
+        return {**self._rooms_manager.stats(), 'subscriptions': self._events.stats()}
+
+    async def _subscribed_status(self, room) -> dict:
+        if not self._events.has_subscribers(room.identifier):
+            return None
+        return await self._room_status(room)
 
     async def create_secret_reissue_room(self, request):
         formula = request.rel_url.query['formula']
-        share_binary = await request.read()
-        json_string = share_binary.decode()
-        json_object = json.loads(json_string)
-        room_id = self._rooms_manager.create_room(json_object['name'], json_object['share_values'],
-                                                  int(json_object['public_key']['n']),
-                                                  int(json_object['public_key']['e']),
-                                                  json_object['formula'],
-                                                  formula, json_object['format_version'])
+        json_object = share_format.decode_share(await request.read())
+        room_id = await self._rooms_manager.create_room(json_object['name'], json_object['share_values'],
+                                                        json_object['public_key']['n'],
+                                                        json_object['public_key']['e'],
+                                                        json_object['formula'],
+                                                        formula, json_object['format_version'])
         return web.Response(text=room_id)
 
-    async def get_secret_reissue_room(self, request):
-        room_id = request.rel_url.query['room_id']
-        room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
-        room_status = 'waiting_participants'
+    async def _room_status(self, room_stored_data) -> dict:
         links_dict = None
-        if room_stored_data.participants_new_shares is not None:
-            room_status = "reissued"
+        if room_stored_data.reissued:
             links_dict = {}
-            for share in room_stored_data.participants_shares:
-                if share.values is not None:
-                    links_dict[share.name] = f"/downloadReissuedSecretShare/{room_id}/{share.name}"
+            for name in room_stored_data.participants_new_shares:
+                if room_stored_data.participants_new_shares.available(name):
+                    links_dict[name] = f"/downloadReissuedSecretShare/{room_stored_data.identifier}/{name}"
                 else:
-                    links_dict[share.name] = None
-        return web.json_response({
-            'signed_count': len(room_stored_data.participants_shares),
-            'participants_count': room_stored_data.participants_count,
-            'room_status': room_status,
+                    links_dict[name] = None
+        return {
+            **room_stored_data.progress(),
             'links': links_dict
-        })
+        }
+
+    async def get_secret_reissue_room(self, request):
+        room_id = request.rel_url.query['room_id']
+        room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
+        return web.json_response(await self._room_status(room_stored_data))
+
+    async def subscribe_secret_reissue_room(self, request):
+        room_id = request.rel_url.query['room_id']
+
+        async def load_status():
+            return await self._room_status(self._rooms_manager.get_room_stored_data(room_id))
+        return await _room_events_response(request, self._events, room_id, load_status)
 
     async def approve_secret_reissue(self, request):
         room_id = request.rel_url.query['room_id']
-        share_binary = await request.read()
-        json_string = share_binary.decode()
-        json_object = json.loads(json_string)
-        room = self._rooms_manager.get_room_stored_data(room_id)
-        room.add_share(json_object['name'], json_object['share_values'])
-        room.try_reissue()
+        json_object = share_format.decode_share(await request.read())
+        async with self._rooms_manager.room_lock(room_id):
+            room = self._rooms_manager.get_room_stored_data(room_id)
+            status = await self._subscribed_status(room)
+            room.add_share(json_object['name'], json_object['share_values'])
+            await room.try_reissue()
+            await self._rooms_manager.save_room_stored_data(room)
+            _publish_changes(self._events, room_id, status, await self._subscribed_status(room),
+                             SECRET_REISSUE_ROOM_EVENTS)
         return web.Response(status=200)
 
+    async def batch_approve_secret_reissue(self, request):
+        data = await request.json()
+        rooms = {}
+        for room_id, items in _group_by_room(data['shares']).items():
+            try:
+                async with self._rooms_manager.room_lock(room_id):
+                    room = self._rooms_manager.get_room_stored_data(room_id)
+                    status = await self._subscribed_status(room)
+                    for item in items:
+                        room.add_share(item['share']['name'], item['share']['share_values'])
+                    await room.try_reissue()
+                    await self._rooms_manager.save_room_stored_data(room)
+                    _publish_changes(self._events, room_id, status, await self._subscribed_status(room),
+                                     SECRET_REISSUE_ROOM_EVENTS)
+                    rooms[room_id] = {'status': 'OK', **room.progress()}
+            except Exception:
+                rooms[room_id] = {'status': 'ERROR'}
+        return web.json_response({'rooms': rooms})
+
     async def download_reissued_secret_share(self, request):
         room_id = request.match_info['room_id']
         user_id = request.match_info['user_id']
-        room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
-        popped_share = room_stored_data.pop_share_by_user(user_id)
-        public_numbers = room_stored_data.public_key.public_numbers()
-        file_fields = {
-            "format_version": room_stored_data.format_version,
-            "name": user_id,
-            "share_values": popped_share,
-            'public_key':
-                {
-                    'n': str(public_numbers.n),
-                    'e': str(public_numbers.e)
-                },
-            "formula": room_stored_data.new_formula
-        }
-        json_string = json.dumps(file_fields)
-        json_bytes = str.encode(json_string)
-        resp_headers = {'Content-Type': 'application/octet-stream',
-                        'Content-Disposition': f'attachment; filename="{room_stored_data.identifier}.sss"'}
-        return web.Response(body=json_bytes, headers=resp_headers)
+        async with self._rooms_manager.room_lock(room_id):
+            room_stored_data = self._rooms_manager.get_room_stored_data(room_id)
+            status = await self._subscribed_status(room_stored_data)
+            popped_share = room_stored_data.pop_share_by_user(user_id)
+            await self._rooms_manager.save_room_stored_data(room_stored_data)
+            _publish_changes(self._events, room_id, status, await self._subscribed_status(room_stored_data),
+                             SECRET_REISSUE_ROOM_EVENTS)
+        file_fields = _share_file_fields(room_stored_data, user_id, popped_share, room_stored_data.new_formula)
+        return share_format.share_response(request, file_fields, f"{room_stored_data.identifier}.sss")
+
+
+def _verify_document(pdf_path: str, e: int, n: int) -> bool:
+    # Only outcomes that hold for good are returned, and cached: other errors, such as the document being collected
+    # while the call was queued, propagate
+    with open(pdf_path, "rb") as pdf_file:
+        pdf_data = pdf_file.read()
+    try:
+        utils.verify_pdf_signature(pdf_data, e, n)
+    except (InvalidSignature, utils.SignatureFormatError):
+        return False
+    return True
 
 
 class APIVerifySignatureHandler:
+    _cache: verification_cache.VerificationCache
+
+    def __init__(self):
+        self._cache = verification_cache.VERIFICATION_CACHE
+
+    async def _verify(self, pdf_document: document_store.StoredDocument, n: int, e: int) -> bool:
+        fingerprint = verification_cache.key_fingerprint(n, e)
+        verified = self._cache.get(pdf_document.sha256, fingerprint)
+        if verified is None:
+            verified = await executor.COMPUTE_EXECUTOR.run(_verify_document, pdf_document.path, e, n,
+                                                             timeout=VERIFY_TIMEOUT_SECONDS)
+            self._cache.put(pdf_document.sha256, fingerprint, verified)
+        return verified
 
     async def verify_signature(self, request):
+        pdf_document = None
         try:
             multipart = await request.multipart()
-            pdf_binary = None
             pdf_name = "document.pdf"
             public_part_binary = None
             while True:
@@ -249,18 +649,72 @@ class APIVerifySignatureHandler:
                 if part is None:
                     break
                 if part.headers[aiohttp.hdrs.CONTENT_TYPE] == 'application/pdf':
-                    pdf_binary = bytes(await part.read())
+                    pdf_document = await document_store.DOCUMENT_STORE.save_part(part)
                     if part.filename is not None:
                         pdf_name = part.filename
                 elif part.headers[aiohttp.hdrs.CONTENT_TYPE] == 'application/octet-stream':
                     public_part_binary = bytes(await part.read())
 
-            json_string = public_part_binary.decode()
-            json_object = json.loads(json_string)
-            utils.verify_pdf_signature(pdf_binary, int(json_object['e']), int(json_object['n']))
+            n, e = share_format.decode_public_key(public_part_binary)
+            verified = await self._verify(pdf_document, n, e)
+        except (executor.ExecutorOverloadedError, executor.ExecutorTimeoutError, document_store.DocumentTooLargeError):
+            raise
         except:
             return web.Response(text='WRONG')
-        return web.Response(text='OK')
+        finally:
+            if pdf_document is not None:
+                pdf_document.discard()
+        return web.Response(text='OK' if verified else 'WRONG')
+
+    async def _bulk_result(self, index: int, name: str, pdf_document: document_store.StoredDocument,
+                           public_key: tuple[int, int], semaphore: asyncio.Semaphore) -> dict:
+        result = {'index': index, 'name': name, 'sha256': pdf_document.sha256}
+        if public_key is None:
+            result['result'] = 'ERROR'
+            return result
+        try:
+            async with semaphore:
+                result['result'] = 'OK' if await self._verify(pdf_document, *public_key) else 'WRONG'
+        except (executor.ExecutorOverloadedError, executor.ExecutorTimeoutError):
+            result['result'] = 'BUSY'
+        except Exception:
+            result['result'] = 'ERROR'
+        return result
+
+    async def bulk_verify_signatures(self, request):
+        # A multipart body of public key (application/octet-stream) and PDF parts, each key applying to the PDFs
+        # that follow it. Documents are verified while the upload continues and one NDJSON line is written per
+        # document as its verification finishes.
+        semaphore = asyncio.Semaphore(BULK_VERIFY_CONCURRENCY)
+        pdf_documents = []
+        tasks = []
+        try:
+            multipart = await request.multipart()
+            public_key = None
+            while True:
+                part = await multipart.next()
+                if part is None:
+                    break
+                if part.headers[aiohttp.hdrs.CONTENT_TYPE] == 'application/pdf':
+                    pdf_document = await document_store.DOCUMENT_STORE.save_part(part)
+                    pdf_documents.append(pdf_document)
+                    tasks.append(asyncio.ensure_future(self._bulk_result(len(tasks), part.filename, pdf_document,
+                                                                         public_key, semaphore)))
+                elif part.headers[aiohttp.hdrs.CONTENT_TYPE] == 'application/octet-stream':
+                    public_key = share_format.decode_public_key(bytes(await part.read()))
+
+            response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+            await response.prepare(request)
+            for task in asyncio.as_completed(tasks):
+                await response.write(json.dumps(await task).encode() + b'\n')
+            await response.write_eof()
+            return response
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for pdf_document in pdf_documents:
+                pdf_document.discard()
 
 
 SECRET_CREATION_HANDLER = APISecretCreationHandler()
@@ -268,20 +722,168 @@ DOCUMENT_SIGNING_HANDLER = APIDocumentSigningHandler()
 SECRET_REISSUE_HANDLER = APISecretReissueHandler()
 VERIFY_SIGNATURE_HANDLER = APIVerifySignatureHandler()
 
+
+ROOM_HANDLERS = [SECRET_CREATION_HANDLER, DOCUMENT_SIGNING_HANDLER, SECRET_REISSUE_HANDLER]
+ROOM_HANDLERS_BY_KIND = {
+    'secret_creation': SECRET_CREATION_HANDLER,
+    'document_signing': DOCUMENT_SIGNING_HANDLER,
+    'secret_reissue': SECRET_REISSUE_HANDLER
+}
+
+
+async def get_rooms_stats(request):
+    return web.json_response({
+        **{kind: handler.rooms_stats() for kind, handler in ROOM_HANDLERS_BY_KIND.items()},
+        'configurations': RoomsManagers.configuration_cache_stats()
+    })
+
+
+def _rooms_gauge(stats_key: str) -> dict[tuple, float]:
+    return {(kind,): handler.rooms_stats().get(stats_key, 0) for kind, handler in ROOM_HANDLERS_BY_KIND.items()}
+
+
+metrics.REGISTRY.register(metrics.CallbackGauge("shamir_rooms", "Live rooms per manager",
+                                                lambda: _rooms_gauge('live_rooms'), ("kind",)))
+metrics.REGISTRY.register(metrics.CallbackGauge("shamir_rooms_loaded", "Rooms held in memory per manager",
+                                                lambda: _rooms_gauge('loaded_rooms'), ("kind",)))
+metrics.REGISTRY.register(metrics.CallbackGauge("shamir_rooms_stored_bytes", "Bytes of shares and documents held",
+                                                lambda: _rooms_gauge('stored_bytes'), ("kind",)))
+metrics.REGISTRY.register(metrics.CallbackGauge("shamir_documents_bytes", "Bytes of documents held on disk",
+                                                lambda: document_store.DOCUMENT_STORE.stats()['bytes']))
+metrics.REGISTRY.register(metrics.CallbackGauge("shamir_executor_queued", "Compute executor calls in flight",
+                                                lambda: executor.COMPUTE_EXECUTOR.stats()['queued']))
+metrics.REGISTRY.register(metrics.CallbackGauge(
+    "shamir_key_pool_depth", "Pre-generated RSA keys ready",
+    lambda: SECRET_CREATION_HANDLER.key_pool_stats()['depth']))
+metrics.REGISTRY.register(metrics.CallbackGauge(
+    "shamir_startup_phase_seconds", "Duration of each startup phase",
+    lambda: {(phase,): seconds for phase, seconds in startup.TIMINGS.phases().items()}, ("phase",)))
+metrics.REGISTRY.register(metrics.CallbackGauge("shamir_ready", "Whether warm-up finished and traffic is welcome",
+                                                lambda: int(startup.READINESS.ready)))
+
+
+async def get_metrics(request):
+    return web.Response(text=metrics.REGISTRY.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+async def get_health(request):
+    return web.json_response({'status': 'ok'})
+
+
+async def get_readiness(request):
+    # Load balancers only route to instances that finished warming up, see _warm_up
+    return web.json_response({**startup.READINESS.stats(), 'startup_seconds': startup.TIMINGS.phases()},
+                             status=200 if startup.READINESS.ready else 503)
+
+
+async def _warm_up_executor():
+    # One call per worker starts the worker processes and has them import what share math and PDF signing need,
+    # instead of the first requests paying for it
+    workers = min(executor.COMPUTE_EXECUTOR.stats()['workers'], executor.EXECUTOR_MAX_QUEUE)
+    await asyncio.gather(*(executor.COMPUTE_EXECUTOR.run(RoomsManagers.warm_up, timeout=WARM_UP_TIMEOUT_SECONDS)
+                           for _ in range(workers)))
+
+
+async def _wait_for_key_pool():
+    key_pool_stats = SECRET_CREATION_HANDLER.key_pool_stats()
+    while key_pool_stats['depth'] < min(startup.READY_MIN_POOLED_KEYS, key_pool_stats['target_depth']):
+        await asyncio.sleep(WARM_UP_POLL_SECONDS)
+        key_pool_stats = SECRET_CREATION_HANDLER.key_pool_stats()
+
+
+async def _warm_up_step(step: str, awaitable: Awaitable):
+    try:
+        await awaitable
+    except Exception as exception:
+        logger.exception("Warm-up step %s failed", step)
+        startup.READINESS.failed(step, type(exception).__name__)
+    else:
+        startup.READINESS.done(step)
+
+
+async def _warm_up_imports():
+    # After the executor step: forking worker processes while a thread holds an import lock deadlocks the workers
+    await _warm_up_step('executor', _warm_up_executor())
+    await _warm_up_step('imports', asyncio.to_thread(RoomsManagers.warm_up))
+
+
+async def _warm_up():
+    for step in ('executor', 'imports', 'key_pool'):
+        startup.READINESS.expect(step)
+    await asyncio.gather(_warm_up_imports(), _warm_up_step('key_pool', _wait_for_key_pool()))
+    startup.TIMINGS.mark("warm_up")
+
+
+async def on_startup(app: web.Application):
+    executor.COMPUTE_EXECUTOR.start()
+    metrics.LOOP_LAG_MONITOR.start()
+    document_store.DOCUMENT_STORE.start()
+    for handler in ROOM_HANDLERS:
+        handler.start()
+    # Runs once the port is open, /readyz answers 503 until it is done
+    WARM_UP_TASKS.append(asyncio.get_running_loop().create_task(_warm_up()))
+    startup.TIMINGS.mark("startup")
+
+
+async def on_cleanup(app: web.Application):
+    for task in WARM_UP_TASKS:
+        task.cancel()
+    await asyncio.gather(*WARM_UP_TASKS, return_exceptions=True)
+    WARM_UP_TASKS.clear()
+    for handler in ROOM_HANDLERS:
+        await handler.stop()
+    if RoomsPersistence.DATABASE is not None:
+        RoomsPersistence.DATABASE.close()
+    await executor.COMPUTE_EXECUTOR.stop()
+    await metrics.LOOP_LAG_MONITOR.stop()
+    await document_store.DOCUMENT_STORE.stop()
+
+
+# Expensive routes get their own admission policy each, so a burst on one of them queues (and is turned away)
+# there instead of slowing down every other route. Cheap status queries are not limited.
+ADMISSION_CONCURRENCY = int(os.environ.get("SHAMIR_ADMISSION_CONCURRENCY", str(executor.EXECUTOR_WORKERS)))
+ADMISSION_MAX_WAITING = int(os.environ.get("SHAMIR_ADMISSION_MAX_WAITING", "32"))
+CLIENT_RATE_PER_SECOND = float(os.environ.get("SHAMIR_CLIENT_RATE_PER_SECOND", "5"))
+CLIENT_BURST = float(os.environ.get("SHAMIR_CLIENT_BURST", "20"))
+
+
+def _admitted(route: str, handler: admission.Handler) -> admission.Handler:
+    policy = admission.AdmissionPolicy(route, ADMISSION_CONCURRENCY, ADMISSION_MAX_WAITING, CLIENT_RATE_PER_SECOND,
+                                       CLIENT_BURST)
+    return policy.wrap(handler)
+
+
 ROUTES_LIST = [
-    web.post('/createSecretRoom', SECRET_CREATION_HANDLER.create_secret_room),
+    web.post('/createSecretRoom', _admitted('createSecretRoom', SECRET_CREATION_HANDLER.create_secret_room)),
+    web.post('/provisionSecretRooms',
+             _admitted('provisionSecretRooms', SECRET_CREATION_HANDLER.provision_secret_rooms)),
     web.get('/getSecretRoom', SECRET_CREATION_HANDLER.get_secret_room),
+    web.get('/subscribeSecretRoom', SECRET_CREATION_HANDLER.subscribe_secret_room),
     web.get('/downloadSecretShare/{room_id}/{user_id}', SECRET_CREATION_HANDLER.download_secret_share),
     web.get('/downloadPublicKey/{room_id}', SECRET_CREATION_HANDLER.download_public_key),
-    web.post('/createSigningRoom', DOCUMENT_SIGNING_HANDLER.create_signing_room),
+    web.post('/batchDownloadSecretShares', SECRET_CREATION_HANDLER.batch_download_secret_shares),
+    web.post('/downloadShareArchive', SECRET_CREATION_HANDLER.download_share_archive),
+    web.get('/getKeyPoolStats', SECRET_CREATION_HANDLER.get_key_pool_stats),
+    web.post('/createSigningRoom', _admitted('createSigningRoom', DOCUMENT_SIGNING_HANDLER.create_signing_room)),
     web.get('/getSigningRoom', DOCUMENT_SIGNING_HANDLER.get_signing_room),
+    web.get('/subscribeSigningRoom', DOCUMENT_SIGNING_HANDLER.subscribe_signing_room),
     web.get('/downloadOriginalDocument/{room_id}', DOCUMENT_SIGNING_HANDLER.download_original_document),
-    web.post('/signDocument', DOCUMENT_SIGNING_HANDLER.sign_document),
-    web.post('/finishSigning', DOCUMENT_SIGNING_HANDLER.finish_signing),
+    web.post('/signDocument', _admitted('signDocument', DOCUMENT_SIGNING_HANDLER.sign_document)),
+    web.post('/batchSignDocument', _admitted('batchSignDocument', DOCUMENT_SIGNING_HANDLER.batch_sign_document)),
+    web.post('/finishSigning', _admitted('finishSigning', DOCUMENT_SIGNING_HANDLER.finish_signing)),
     web.get('/downloadSignedDocument/{room_id}', DOCUMENT_SIGNING_HANDLER.download_signed_document),
     web.post('/createSecretReissueRoom', SECRET_REISSUE_HANDLER.create_secret_reissue_room),
     web.get('/getSecretReissueRoom', SECRET_REISSUE_HANDLER.get_secret_reissue_room),
-    web.post('/approveSecretReissue', SECRET_REISSUE_HANDLER.approve_secret_reissue),
+    web.get('/subscribeSecretReissueRoom', SECRET_REISSUE_HANDLER.subscribe_secret_reissue_room),
+    web.post('/approveSecretReissue', _admitted('approveSecretReissue', SECRET_REISSUE_HANDLER.approve_secret_reissue)),
+    web.post('/batchApproveSecretReissue',
+             _admitted('batchApproveSecretReissue', SECRET_REISSUE_HANDLER.batch_approve_secret_reissue)),
     web.get('/downloadReissuedSecretShare/{room_id}/{user_id}', SECRET_REISSUE_HANDLER.download_reissued_secret_share),
-    web.post('/verifySignature', VERIFY_SIGNATURE_HANDLER.verify_signature)
+    web.post('/verifySignature', _admitted('verifySignature', VERIFY_SIGNATURE_HANDLER.verify_signature)),
+    web.post('/bulkVerifySignatures',
+             _admitted('bulkVerifySignatures', VERIFY_SIGNATURE_HANDLER.bulk_verify_signatures)),
+    web.get('/getRoomsStats', get_rooms_stats),
+    web.get('/metrics', get_metrics),
+    web.get('/healthz', get_health),
+    web.get('/readyz', get_readiness)
 ]
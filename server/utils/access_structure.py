@@ -0,0 +1,85 @@
+from array import array
+import re
+
+# Threshold gates as written by the API: T<k>(child, child, ...), children are participant names or nested gates
+_GATE_PREFIX = re.compile(r"\s*T(\d+)\s*\(")
+
+
+class FormulaParseError(Exception):
+    pass
+
+
+class _Gate:
+    __slots__ = ("index", "threshold", "parent")
+
+    def __init__(self, index: int, threshold: int, parent: "_Gate"):
+        self.index = index
+        self.threshold = threshold
+        self.parent = parent
+
+
+class AccessStructure:
+    # Parsed once per formula and shared by every room using it: the state of one set of names is the array of
+    # satisfied children per gate returned by counts(), which each room keeps and passes to add()
+    _root: _Gate
+    _gates: list[_Gate]
+    _leaves: dict[str, _Gate]
+
+    def __init__(self, formula: str):
+        self._gates = []
+        self._leaves = {}
+        self._root, position = self._parse_gate(formula, 0, None)
+        if formula[position:].strip():
+            raise FormulaParseError(formula)
+
+    def _parse_gate(self, formula: str, position: int, parent: _Gate) -> (_Gate, int):
+        match = _GATE_PREFIX.match(formula, position)
+        if match is None:
+            raise FormulaParseError(formula)
+        gate = _Gate(len(self._gates), int(match.group(1)), parent)
+        self._gates.append(gate)
+        position = match.end()
+        children_count = 0
+        while True:
+            if _GATE_PREFIX.match(formula, position):
+                _, position = self._parse_gate(formula, position, gate)
+            else:
+                end = position
+                while end < len(formula) and formula[end] not in ",()":
+                    end += 1
+                name = formula[position:end].strip()
+                # A name written twice stands for two shares while rooms keep one per name, only a trial restore
+                # can tell what such formulas need
+                if not name or name in self._leaves:
+                    raise FormulaParseError(formula)
+                self._leaves[name] = gate
+                position = end
+            children_count += 1
+            if position >= len(formula):
+                raise FormulaParseError(formula)
+            if formula[position] == ",":
+                position += 1
+            elif formula[position] == ")":
+                position += 1
+                break
+            else:
+                raise FormulaParseError(formula)
+        if not 0 < gate.threshold <= children_count:
+            raise FormulaParseError(formula)
+        return gate, position
+
+    def counts(self) -> array:
+        return array("I", [0]) * len(self._gates)
+
+    def add(self, counts: array, name: str) -> bool:
+        # Counts a name not added to counts before, returns whether the names counted so far satisfy the formula
+        gate = self._leaves.get(name)
+        while gate is not None:
+            counts[gate.index] += 1
+            if counts[gate.index] != gate.threshold:
+                break
+            gate = gate.parent
+        return counts[self._root.index] >= self._root.threshold
+
+    def names(self) -> list[str]:
+        return list(self._leaves)
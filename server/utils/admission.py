@@ -0,0 +1,118 @@
+from aiohttp import web
+from collections import OrderedDict
+from typing import Awaitable, Callable
+import functools
+import asyncio
+import math
+import time
+import os
+
+from server.utils import metrics
+from server.utils import errors
+
+ADMISSION_RETRY_AFTER_SECONDS = int(os.environ.get("SHAMIR_ADMISSION_RETRY_AFTER_SECONDS", "1"))
+ADMISSION_MAX_CLIENTS = int(os.environ.get("SHAMIR_ADMISSION_MAX_CLIENTS", "10000"))
+# Only behind a reverse proxy that sets it: otherwise any client can pick its own rate limit bucket
+TRUST_FORWARDED_FOR = os.environ.get("SHAMIR_TRUST_FORWARDED_FOR", "0") == "1"
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+REJECTIONS_TOTAL = metrics.REGISTRY.register(metrics.Counter("shamir_admission_rejections_total",
+                                                             "Requests turned away by admission control",
+                                                             ("policy", "reason")))
+
+
+def client_id(request: web.Request) -> str:
+    if TRUST_FORWARDED_FOR and 'X-Forwarded-For' in request.headers:
+        return request.headers['X-Forwarded-For'].split(',')[0].strip()
+    return request.remote
+
+
+class TokenBuckets:
+    # One token bucket per client, refilled at rate tokens per second up to burst. Idle clients beyond max_clients
+    # are forgotten, which only ever hands them a full bucket again.
+    _buckets: OrderedDict[str, tuple[float, float]]
+    _rate: float
+    _burst: float
+
+    def __init__(self, rate: float, burst: float, max_clients: int = ADMISSION_MAX_CLIENTS):
+        self._buckets = OrderedDict()
+        self._rate = rate
+        self._burst = burst
+        self._max_clients = max_clients
+
+    def take(self, client: str) -> float:
+        # Returns 0 when a token was taken, otherwise the seconds until the next one
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(client, (self._burst, now))
+        tokens = min(self._burst, tokens + (now - updated) * self._rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self._rate
+        self._buckets[client] = (tokens, now)
+        while len(self._buckets) > self._max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+class AdmissionPolicy:
+    # Admission for an expensive route: per-client rate limiting, then at most concurrency handlers at once
+    # with up to max_waiting more queued behind them. Anything beyond is answered right away instead of piling up.
+    name: str
+    _semaphore: asyncio.Semaphore
+    _buckets: TokenBuckets
+
+    def __init__(self, name: str, concurrency: int, max_waiting: int, rate: float = 0, burst: float = 1,
+                 retry_after: int = ADMISSION_RETRY_AFTER_SECONDS):
+        self.name = name
+        self._concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._max_waiting = max_waiting
+        self._buckets = TokenBuckets(rate, burst) if rate > 0 else None
+        self._retry_after = retry_after
+        self._in_flight = 0
+        self._waiting = 0
+        POLICIES.append(self)
+
+    def wrap(self, handler: Handler) -> Handler:
+        @functools.wraps(handler)
+        async def admitted(request: web.Request) -> web.StreamResponse:
+            if self._buckets is not None:
+                wait = self._buckets.take(client_id(request))
+                if wait > 0:
+                    REJECTIONS_TOTAL.inc(self.name, "rate_limited")
+                    return errors.error_response(429, 'Too many requests', {'Retry-After': str(math.ceil(wait))})
+            if self._semaphore.locked() and self._waiting >= self._max_waiting:
+                REJECTIONS_TOTAL.inc(self.name, "queue_full")
+                return errors.error_response(503, 'Server is busy', {'Retry-After': str(self._retry_after)})
+            self._waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self._waiting -= 1
+            self._in_flight += 1
+            try:
+                return await handler(request)
+            finally:
+                self._in_flight -= 1
+                self._semaphore.release()
+        return admitted
+
+    def stats(self) -> dict:
+        return {
+            'concurrency': self._concurrency,
+            'in_flight': self._in_flight,
+            'waiting': self._waiting,
+            'max_waiting': self._max_waiting
+        }
+
+
+POLICIES: list[AdmissionPolicy] = []
+metrics.REGISTRY.register(metrics.CallbackGauge(
+    "shamir_admission_in_flight", "Requests running under an admission policy",
+    lambda: {(policy.name,): policy.stats()['in_flight'] for policy in POLICIES}, ("policy",)))
+metrics.REGISTRY.register(metrics.CallbackGauge(
+    "shamir_admission_waiting", "Requests queued by an admission policy",
+    lambda: {(policy.name,): policy.stats()['waiting'] for policy in POLICIES}, ("policy",)))
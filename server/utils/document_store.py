@@ -0,0 +1,252 @@
+from aiohttp import BodyPartReader
+from server.utils import utils
+import asyncio
+import hashlib
+import logging
+import shutil
+import tempfile
+import uuid
+import os
+
+DOCUMENTS_DIRECTORY = os.environ.get("SHAMIR_DOCUMENTS_DIRECTORY")
+if DOCUMENTS_DIRECTORY is None and os.environ.get("SHAMIR_ROOMS_DATABASE"):
+    # Documents of persisted rooms have to outlive the process, so they are kept next to the rooms database
+    DOCUMENTS_DIRECTORY = os.environ["SHAMIR_ROOMS_DATABASE"] + ".documents"
+MAX_DOCUMENT_SIZE = int(os.environ.get("SHAMIR_MAX_DOCUMENT_SIZE", str(64 * 1024 * 1024)))
+# Uploads no room refers to any more (and their canonical forms) are kept for reuse up to this many bytes
+DOCUMENT_CACHE_MAX_BYTES = int(os.environ.get("SHAMIR_DOCUMENT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Also how often the figures of stats() are refreshed
+COLLECT_INTERVAL_SECONDS = 60
+CHUNK_SIZE = 64 * 1024
+OBJECTS_DIRECTORY = "objects"
+CANONICAL_DIRECTORY = "canonical"
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentTooLargeError(Exception):
+    pass
+
+
+class StoredDocument:
+    __slots__ = ("path", "size", "sha256")
+
+    def __init__(self, path: str, size: int, sha256: str):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as document_file:
+            return document_file.read()
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DocumentStore:
+    # Uploads are content addressed: each distinct document is stored once as objects/<sha256> and every room gets
+    # its own hard link to it, which discard() removes again. The link count is thus the reference count, shared by
+    # every process using the directory and kept across restarts. Objects down to their last link are only a cache
+    # and are collected least recently used first once they exceed cache_max_bytes.
+    _directory: str
+    _temporary: bool
+    _max_size: int
+    _cache_max_bytes: int
+    _collector_task: asyncio.Task
+    _stats: dict
+
+    def __init__(self, directory: str = DOCUMENTS_DIRECTORY, max_size: int = MAX_DOCUMENT_SIZE,
+                 cache_max_bytes: int = DOCUMENT_CACHE_MAX_BYTES):
+        self._directory = directory
+        self._temporary = directory is None
+        self._max_size = max_size
+        self._cache_max_bytes = cache_max_bytes
+        self._collector_task = None
+        self._stats = {'documents': 0, 'objects': 0, 'bytes': 0, 'cached_bytes': 0}
+
+    @property
+    def directory(self) -> str:
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix="shamir-documents-")
+        os.makedirs(os.path.join(self._directory, OBJECTS_DIRECTORY), exist_ok=True)
+        os.makedirs(os.path.join(self._directory, CANONICAL_DIRECTORY), exist_ok=True)
+        return self._directory
+
+    def reserve_path(self) -> str:
+        return os.path.join(self.directory, uuid.uuid4().hex)
+
+    def _object_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, OBJECTS_DIRECTORY, sha256)
+
+    def canonical_path(self, sha256: str) -> str:
+        return os.path.join(self.directory, CANONICAL_DIRECTORY, sha256)
+
+    def _intern(self, path: str, sha256: str) -> str:
+        # Turns a freshly written upload into a reference to the object with its content, returns the reference path
+        object_path = self._object_path(sha256)
+        reference_path = self.reserve_path()
+        try:
+            while True:
+                try:
+                    os.link(object_path, reference_path)
+                    os.remove(path)
+                    break
+                except FileNotFoundError:
+                    pass
+                try:
+                    os.link(path, object_path)
+                    os.replace(path, reference_path)
+                    break
+                except FileExistsError:
+                    # Published by a concurrent upload in between, link to that one instead
+                    continue
+        except OSError:
+            # No hard links on this file system: the upload stays a document of its own
+            return path
+        try:
+            os.utime(object_path)
+        except FileNotFoundError:
+            pass
+        return reference_path
+
+    async def save_part(self, part: BodyPartReader) -> StoredDocument:
+        path = self.reserve_path()
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(path, "wb") as document_file:
+                while chunk := await part.read_chunk(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self._max_size:
+                        raise DocumentTooLargeError()
+                    digest.update(chunk)
+                    document_file.write(chunk)
+        except BaseException:
+            os.remove(path)
+            raise
+        sha256 = digest.hexdigest()
+        return StoredDocument(self._intern(path, sha256), size, sha256)
+
+    def collect(self) -> int:
+        # Also takes the figures reported by stats(), so that metrics scrapes never walk the directory themselves.
+        # Runs in a thread, see _collect_forever.
+        directory = self.directory
+        documents_count = 0
+        objects_count = 0
+        documents_bytes = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    documents_count += 1
+                    # Links to an object are accounted for with the object
+                    stat = entry.stat()
+                    if stat.st_nlink == 1:
+                        documents_bytes += stat.st_size
+        unreferenced = []
+        cached_bytes = 0
+        with os.scandir(os.path.join(directory, OBJECTS_DIRECTORY)) as entries:
+            for entry in entries:
+                stat = entry.stat()
+                objects_count += 1
+                documents_bytes += stat.st_size
+                if stat.st_nlink > 1:
+                    continue
+                size = stat.st_size + _file_size(self.canonical_path(entry.name))
+                unreferenced.append((stat.st_mtime, entry.name, size))
+                cached_bytes += size
+        with os.scandir(os.path.join(directory, CANONICAL_DIRECTORY)) as entries:
+            for entry in entries:
+                stat = entry.stat()
+                documents_bytes += stat.st_size
+                # Canonical forms of documents stored before content addressing have no object to go with, dot
+                # files are canonical forms still being written
+                if not entry.name.startswith(".") and not os.path.exists(self._object_path(entry.name)):
+                    unreferenced.append((stat.st_mtime, entry.name, stat.st_size))
+                    cached_bytes += stat.st_size
+        unreferenced.sort()
+        removed = 0
+        for _, sha256, size in unreferenced:
+            if cached_bytes <= self._cache_max_bytes:
+                break
+            # A concurrent upload may have linked the object meanwhile: its reference keeps the content alive, only
+            # the deduplication of later uploads is lost
+            for path in (self._object_path(sha256), self.canonical_path(sha256)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                if path == self._object_path(sha256):
+                    objects_count -= 1
+            cached_bytes -= size
+            documents_bytes -= size
+            removed += 1
+        self._stats = {'documents': documents_count, 'objects': objects_count, 'bytes': documents_bytes,
+                       'cached_bytes': cached_bytes}
+        return removed
+
+    async def _collect_forever(self, interval: float):
+        while True:
+            try:
+                await asyncio.to_thread(self.collect)
+            except OSError:
+                logger.exception("Document cache collection failed")
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float = COLLECT_INTERVAL_SECONDS):
+        if self._collector_task is None:
+            self._collector_task = asyncio.get_running_loop().create_task(self._collect_forever(interval))
+
+    def stats(self) -> dict:
+        # As of the last collection
+        return dict(self._stats)
+
+    async def stop(self):
+        if self._collector_task is not None:
+            self._collector_task.cancel()
+            try:
+                await self._collector_task
+            except asyncio.CancelledError:
+                pass
+            self._collector_task = None
+        if self._temporary and self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def write_document(path: str, data: bytes) -> StoredDocument:
+    with open(path, "wb") as document_file:
+        document_file.write(data)
+    return StoredDocument(path, len(data), hashlib.sha256(data).hexdigest())
+
+
+def canonical_document(path: str, canonical_path: str) -> (bytes, bytes):
+    # Worker side: a document is canonicalized once per distinct content and then reused by every room signing it.
+    # The digest is recomputed from the stored form, a hash pass is nothing next to the pypdf rewrite.
+    try:
+        with open(canonical_path, "rb") as canonical_file:
+            canonical_data = canonical_file.read()
+        os.utime(canonical_path)
+        return canonical_data, hashlib.sha256(canonical_data).digest()
+    except FileNotFoundError:
+        pass
+    with open(path, "rb") as document_file:
+        canonical_data, hash_value = utils.canonicalize_pdf(document_file.read())
+    temporary_path = os.path.join(os.path.dirname(canonical_path), f".{uuid.uuid4().hex}")
+    with open(temporary_path, "wb") as canonical_file:
+        canonical_file.write(canonical_data)
+    os.replace(temporary_path, canonical_path)
+    return canonical_data, hash_value
+
+
+DOCUMENT_STORE = DocumentStore()
@@ -0,0 +1,7 @@
+from aiohttp import web
+
+
+def error_response(status: int, description: str, headers: dict = None) -> web.Response:
+    # Same body as the errors built by the Catcher scenarios in main.py, for handlers answering errors themselves
+    return web.json_response({'message': None, 'code': status, 'type': 'ERROR', 'description': description},
+                             status=status, headers=headers)
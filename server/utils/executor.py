@@ -0,0 +1,124 @@
+from server.utils import metrics
+from server.utils import profiling
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable
+import functools
+import asyncio
+import time
+import os
+
+EXECUTOR_BACKEND = os.environ.get("SHAMIR_EXECUTOR_BACKEND", "process")
+# Server processes share the machine's cores between their executors
+_SERVER_WORKERS = int(os.environ.get("SHAMIR_WORKERS", "1"))
+EXECUTOR_WORKERS = int(os.environ.get("SHAMIR_EXECUTOR_WORKERS", str(max(1, (os.cpu_count() or 1) // _SERVER_WORKERS))))
+EXECUTOR_MAX_QUEUE = int(os.environ.get("SHAMIR_EXECUTOR_MAX_QUEUE", "64"))
+EXECUTOR_TIMEOUT_SECONDS = float(os.environ.get("SHAMIR_EXECUTOR_TIMEOUT_SECONDS", "120"))
+
+# Functions dispatched through a process backend must be module-level and take and return picklable values
+BACKENDS: dict[str, Callable[[int], Executor]] = {
+    "thread": lambda workers: ThreadPoolExecutor(max_workers=workers),
+    "process": lambda workers: ProcessPoolExecutor(max_workers=workers),
+}
+
+
+class ExecutorOverloadedError(Exception):
+    pass
+
+
+class ExecutorTimeoutError(Exception):
+    pass
+
+
+class ComputeExecutor:
+    _executor: Executor
+    _backend: str
+    _workers: int
+    _max_queue: int
+    _timeout: float
+    _queued: int
+
+    def __init__(self, backend: str = EXECUTOR_BACKEND, workers: int = EXECUTOR_WORKERS,
+                 max_queue: int = EXECUTOR_MAX_QUEUE, timeout: float = EXECUTOR_TIMEOUT_SECONDS):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown executor backend {backend}")
+        self._executor = None
+        self._backend = backend
+        self._workers = workers
+        self._max_queue = max_queue
+        self._timeout = timeout
+        self._queued = 0
+        self._completed_count = 0
+        self._failed_count = 0
+        self._rejected_count = 0
+        self._timed_out_count = 0
+
+    def start(self):
+        if self._executor is None:
+            self._executor = BACKENDS[self._backend](self._workers)
+
+    async def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _release(self):
+        self._queued -= 1
+
+    def _release_soon(self, loop: asyncio.AbstractEventLoop, future: Future):
+        # Called by the pool once it is done with a call, whether or not anyone still awaits it
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # The loop is closed, there is no queue left to bound
+            pass
+
+    async def run(self, function: Callable, *args, timeout: float = None):
+        if self._queued >= self._max_queue:
+            self._rejected_count += 1
+            raise ExecutorOverloadedError()
+        self.start()
+        loop = asyncio.get_running_loop()
+        profiles = profiling.current_profiles()
+        if profiles:
+            future = self._executor.submit(metrics.run_collecting, profiling.run_profiled,
+                                           profiling.worker_modes(profiles), profiling.SAMPLING_INTERVAL_SECONDS,
+                                           function, *args)
+        else:
+            future = self._executor.submit(metrics.run_collecting, function, *args)
+        # The slot is held until the pool is done with the call: a timed out call that already started keeps its
+        # worker busy, one still waiting for a worker is cancelled by wait_for
+        self._queued += 1
+        future.add_done_callback(functools.partial(self._release_soon, loop))
+        start = time.perf_counter()
+        try:
+            result, timings = await asyncio.wait_for(asyncio.wrap_future(future),
+                                                     timeout if timeout is not None else self._timeout)
+        except asyncio.TimeoutError:
+            self._timed_out_count += 1
+            raise ExecutorTimeoutError()
+        except Exception:
+            self._failed_count += 1
+            raise
+        finally:
+            metrics.EXECUTOR_SECONDS.observe(time.perf_counter() - start, function.__name__.lstrip('_'))
+        self._completed_count += 1
+        metrics.record_stages(timings)
+        if profiles:
+            result, profile_data = result
+            profiling.record_worker_profile(profiles, profile_data)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            'backend': self._backend,
+            'workers': self._workers,
+            'queued': self._queued,
+            'max_queue': self._max_queue,
+            'completed': self._completed_count,
+            'failed': self._failed_count,
+            'rejected': self._rejected_count,
+            'timed_out': self._timed_out_count
+        }
+
+
+COMPUTE_EXECUTOR = ComputeExecutor()
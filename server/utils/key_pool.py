@@ -0,0 +1,128 @@
+from server.utils import metrics
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import asyncio
+import logging
+import time
+import os
+
+KEY_PUBLIC_EXPONENT = 65537
+KEY_SIZE = 4096
+KEY_POOL_SIZE = int(os.environ.get("SHAMIR_KEY_POOL_SIZE", "8"))
+KEY_POOL_WORKERS = int(os.environ.get("SHAMIR_KEY_POOL_WORKERS", "2"))
+REFILL_RATE_WINDOW_SECONDS = 300
+
+logger = logging.getLogger(__name__)
+
+
+def _generate_key_der(public_exponent: int, key_size: int) -> bytes:
+    # Runs inside a worker process, so the key is handed back in a picklable form
+    with metrics.stage("key_generation"):
+        key = rsa.generate_private_key(public_exponent=public_exponent, key_size=key_size)
+    return key.private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption())
+
+
+def _load_key_der(key_der: bytes) -> rsa.RSAPrivateKey:
+    # The key was generated by us a moment ago, OpenSSL's primality re-check is pure overhead
+    return serialization.load_der_private_key(key_der, password=None, unsafe_skip_rsa_key_validation=True)
+
+
+class RSAKeyPool:
+    _keys: deque
+    _size: int
+    _workers: int
+    _executor: ProcessPoolExecutor
+    _pending: int
+    _generated_timestamps: deque
+
+    def __init__(self, size: int = KEY_POOL_SIZE, workers: int = KEY_POOL_WORKERS,
+                 public_exponent: int = KEY_PUBLIC_EXPONENT, key_size: int = KEY_SIZE):
+        self._keys = deque()
+        self._size = size
+        self._workers = workers
+        self._public_exponent = public_exponent
+        self._key_size = key_size
+        self._executor = None
+        self._pending = 0
+        self._generated_timestamps = deque()
+        self._generated_count = 0
+        self._served_count = 0
+        self._miss_count = 0
+        self._failed_count = 0
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._workers)
+        self._refill()
+
+    async def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _refill(self):
+        if self._executor is None:
+            return
+        loop = asyncio.get_running_loop()
+        while len(self._keys) + self._pending < self._size:
+            self._pending += 1
+            future = loop.run_in_executor(self._executor, metrics.run_collecting, _generate_key_der,
+                                          self._public_exponent, self._key_size)
+            future.add_done_callback(self._on_key_generated)
+
+    def _on_key_generated(self, future: asyncio.Future):
+        self._pending -= 1
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            # Do not refill from here, a broken worker pool would otherwise spin forever
+            self._failed_count += 1
+            logger.error("RSA key generation failed", exc_info=future.exception())
+            return
+        key_der, timings = future.result()
+        metrics.record_stages(timings)
+        self._keys.append(_load_key_der(key_der))
+        self._record_generated()
+        self._refill()
+
+    def _record_generated(self):
+        now = time.monotonic()
+        self._generated_count += 1
+        self._generated_timestamps.append(now)
+        while self._generated_timestamps[0] < now - REFILL_RATE_WINDOW_SECONDS:
+            self._generated_timestamps.popleft()
+
+    async def acquire(self) -> rsa.RSAPrivateKey:
+        if self._keys:
+            key = self._keys.popleft()
+            self._served_count += 1
+            self._refill()
+            return key
+        # Pool is drained: generate this one on demand, still off the event loop
+        self._miss_count += 1
+        loop = asyncio.get_running_loop()
+        key_der, timings = await loop.run_in_executor(self._executor, metrics.run_collecting, _generate_key_der,
+                                                      self._public_exponent, self._key_size)
+        metrics.record_stages(timings)
+        self._record_generated()
+        self._served_count += 1
+        self._refill()
+        return _load_key_der(key_der)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        recent = [timestamp for timestamp in self._generated_timestamps
+                  if timestamp >= now - REFILL_RATE_WINDOW_SECONDS]
+        return {
+            'depth': len(self._keys),
+            'target_depth': self._size,
+            'pending': self._pending,
+            'generated': self._generated_count,
+            'served': self._served_count,
+            'misses': self._miss_count,
+            'failed': self._failed_count,
+            'refill_rate_per_minute': len(recent) * 60 / REFILL_RATE_WINDOW_SECONDS
+        }
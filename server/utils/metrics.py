@@ -0,0 +1,232 @@
+from aiohttp import web
+from contextlib import contextmanager
+from typing import Callable
+import threading
+import asyncio
+import bisect
+import time
+import os
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LOOP_LAG_INTERVAL_SECONDS = float(os.environ.get("SHAMIR_LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(label_names, label_values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Histogram:
+    name: str
+    _help: str
+    _label_names: tuple[str, ...]
+    _buckets: tuple[float, ...]
+    _series: dict[tuple, list]
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self._help = help_text
+        self._label_names = label_names
+        self._buckets = buckets
+        self._series = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            # Per-bucket counts followed by the sum and the total count
+            series = self._series[label_values] = [0] * (len(self._buckets) + 2)
+        bucket_index = bisect.bisect_left(self._buckets, value)
+        if bucket_index < len(self._buckets):
+            series[bucket_index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self._help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bucket, count in zip(self._buckets, series):
+                cumulative += count
+                labels = _format_labels(self._label_names, label_values, f'le="{bucket}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self._label_names, label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = _format_labels(self._label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Counter:
+    name: str
+    _help: str
+    _label_names: tuple[str, ...]
+    _values: dict[tuple, float]
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self._help = help_text
+        self._label_names = label_names
+        self._values = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self._help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self._label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class CallbackGauge:
+    # The callback returns either a single value or a dict from label value tuples to values
+    name: str
+    _help: str
+    _label_names: tuple[str, ...]
+    _callback: Callable[[], float | dict[tuple, float]]
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], float | dict[tuple, float]],
+                 label_names: tuple[str, ...] = ()):
+        self.name = name
+        self._help = help_text
+        self._label_names = label_names
+        self._callback = callback
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self._help}", f"# TYPE {self.name} gauge"]
+        values = self._callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self._label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    _metrics: dict[str, Histogram | Counter | CallbackGauge]
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: Histogram | Counter | CallbackGauge):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+REQUEST_SECONDS = REGISTRY.register(Histogram("shamir_http_request_duration_seconds",
+                                              "Time spent handling HTTP requests", ("route", "method")))
+RESPONSES_TOTAL = REGISTRY.register(Counter("shamir_http_responses_total", "HTTP responses by status",
+                                            ("route", "status")))
+EXCEPTIONS_TOTAL = REGISTRY.register(Counter("shamir_http_exceptions_total",
+                                             "Exceptions raised by handlers, before error responses are built",
+                                             ("route", "exception")))
+STAGE_SECONDS = REGISTRY.register(Histogram("shamir_stage_duration_seconds",
+                                            "Time spent in processing stages such as split, restore or sign",
+                                            ("stage",)))
+EXECUTOR_SECONDS = REGISTRY.register(Histogram("shamir_executor_call_duration_seconds",
+                                               "Compute executor calls including queueing", ("function",)))
+LOOP_LAG_SECONDS = REGISTRY.register(Histogram("shamir_event_loop_lag_seconds",
+                                               "Delay of event loop wake-ups past their deadline"))
+
+_collector = threading.local()
+
+
+@contextmanager
+def stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = getattr(_collector, "timings", None)
+        if timings is not None:
+            timings.append((name, elapsed))
+        else:
+            STAGE_SECONDS.observe(elapsed, name)
+
+
+def run_collecting(function: Callable, *args) -> tuple:
+    # Executor entry point: stages timed inside a worker process would be lost with it, so they are handed back
+    # along with the result and recorded by the caller with record_stages
+    _collector.timings = []
+    try:
+        return function(*args), _collector.timings
+    finally:
+        _collector.timings = None
+
+
+def record_stages(timings: list[tuple[str, float]]):
+    for name, elapsed in timings:
+        STAGE_SECONDS.observe(elapsed, name)
+
+
+@web.middleware
+async def middleware(request: web.Request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    start = time.perf_counter()
+    try:
+        response = await handler(request)
+    except BaseException as exception:
+        EXCEPTIONS_TOTAL.inc(route, type(exception).__name__)
+        raise
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, route, request.method)
+    RESPONSES_TOTAL.inc(route, response.status)
+    return response
+
+
+class LoopLagMonitor:
+    _interval: float
+    _last_lag: float
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SECONDS):
+        self._interval = interval
+        self._last_lag = 0.0
+        self._task = None
+
+    @property
+    def last_lag(self) -> float:
+        return self._last_lag
+
+    async def _measure_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            deadline = loop.time() + self._interval
+            await asyncio.sleep(self._interval)
+            self._last_lag = max(0.0, loop.time() - deadline)
+            LOOP_LAG_SECONDS.observe(self._last_lag)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._measure_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+LOOP_LAG_MONITOR = LoopLagMonitor()
+REGISTRY.register(CallbackGauge("shamir_event_loop_lag_last_seconds", "Most recent event loop lag measurement",
+                                lambda: LOOP_LAG_MONITOR.last_lag))
@@ -0,0 +1,384 @@
+from aiohttp import web
+from collections import Counter, deque
+from contextvars import ContextVar
+from io import StringIO
+from typing import Callable
+import threading
+import cProfile
+import asyncio
+import marshal
+import pstats
+import hmac
+import time
+import sys
+import os
+
+from server.utils import errors
+
+# Profiling routes are only served with a token set, requests then authenticate with "Authorization: Bearer <token>"
+ADMIN_TOKEN = os.environ.get("SHAMIR_ADMIN_TOKEN")
+SAMPLING_INTERVAL_SECONDS = float(os.environ.get("SHAMIR_PROFILE_SAMPLING_INTERVAL_SECONDS", "0.005"))
+# Requests slower than this keep their sampled profile, 0 turns slow request capture off
+SLOW_REQUEST_SECONDS = float(os.environ.get("SHAMIR_PROFILE_SLOW_REQUEST_SECONDS", "0"))
+SLOW_REQUESTS_KEPT = int(os.environ.get("SHAMIR_PROFILE_SLOW_REQUESTS_KEPT", "20"))
+MAX_CAPTURE_SECONDS = float(os.environ.get("SHAMIR_PROFILE_MAX_CAPTURE_SECONDS", "300"))
+PSTATS_TEXT_LIMIT = 60
+
+SAMPLING = "sampling"
+CPROFILE = "cprofile"
+MODES = (SAMPLING, CPROFILE)
+FORMATS = ("collapsed", "pstats", "text")
+
+_current_profiles: ContextVar[tuple] = ContextVar("profiles", default=())
+
+
+class ProfileError(Exception):
+    pass
+
+
+class ProfileRequestError(Exception):
+    pass
+
+
+def _collapse(frame) -> str:
+    # One line of the collapsed stack format read by flamegraph.pl and speedscope, outermost frame first
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _is_idle(frame) -> bool:
+    return frame.f_code.co_filename.endswith("selectors.py")
+
+
+class _RawStats:
+    # What pstats.Stats loads from: anything with create_stats() and a stats dict, as a cProfile.Profile has
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profile:
+    # Sampled stacks and cProfile statistics gathered for one request or capture window, from the event loop thread
+    # and from every executor call made on its behalf. The sampler thread adds to it concurrently.
+    modes: tuple[str, ...]
+    _stacks: Counter
+    _stats: pstats.Stats
+
+    def __init__(self, modes: tuple[str, ...]):
+        self.modes = modes
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._stats = None
+
+    def add(self, stacks: dict = None, stats: dict = None):
+        with self._lock:
+            if stacks:
+                self._stacks.update(stacks)
+            if stats:
+                if self._stats is None:
+                    self._stats = pstats.Stats(_RawStats(stats))
+                else:
+                    self._stats.add(_RawStats(stats))
+
+    def collapsed(self) -> str:
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in sorted(self._stacks.items()))
+
+    def pstats_dump(self) -> bytes:
+        # Same bytes as pstats.Stats.dump_stats writes, loadable with pstats, snakeviz or flameprof
+        with self._lock:
+            if self._stats is None:
+                raise ProfileError("No cProfile statistics in this profile")
+            return marshal.dumps(self._stats.stats)
+
+    def pstats_text(self) -> str:
+        with self._lock:
+            if self._stats is None:
+                raise ProfileError("No cProfile statistics in this profile")
+            stream = StringIO()
+            self._stats.stream = stream
+            self._stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PSTATS_TEXT_LIMIT)
+            return stream.getvalue()
+
+
+class _ThreadSampler:
+    # Samples the stack of one thread from a helper thread until stopped
+    _stacks: Counter
+
+    def __init__(self, thread_id: int, interval: float):
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample_forever, name="profiling-sampler", daemon=True)
+
+    def _sample_forever(self):
+        while not self._stopped.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self._stacks[_collapse(frame)] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> dict:
+        self._stopped.set()
+        self._thread.join()
+        return dict(self._stacks)
+
+
+def run_profiled(modes: tuple[str, ...], interval: float, function: Callable, *args) -> tuple:
+    # Executor entry point for calls made while their request is profiled. Runs in the worker thread or process and
+    # hands the profile back along with the result, like metrics.run_collecting does with stage timings.
+    sampler = None
+    profiler = None
+    if SAMPLING in modes:
+        sampler = _ThreadSampler(threading.get_ident(), interval)
+        sampler.start()
+    if CPROFILE in modes:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler already runs in this process (one per process from Python 3.12 on)
+            profiler = None
+    try:
+        result = function(*args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        stacks = sampler.stop() if sampler is not None else None
+    stats = None
+    if profiler is not None:
+        profiler.create_stats()
+        stats = profiler.stats
+    return result, {'stacks': stacks, 'stats': stats}
+
+
+def current_profiles() -> tuple:
+    return _current_profiles.get()
+
+
+def worker_modes(profiles: tuple) -> tuple[str, ...]:
+    return tuple(sorted({mode for profile in profiles for mode in profile.modes}))
+
+
+def record_worker_profile(profiles: tuple, profile_data: dict):
+    for profile in profiles:
+        profile.add(profile_data['stacks'], profile_data['stats'])
+
+
+class _Capture:
+    profile: Profile
+    route: str
+
+    def __init__(self, profile: Profile, route: str):
+        self.profile = profile
+        self.route = route
+
+
+class Profiler:
+    # Process-wide profiling state: at most one capture window at a time, optionally limited to one route, and
+    # slow request capture. One sampler thread samples the event loop thread while either is on and files each
+    # sample under the profiles of the request whose task is running.
+    _capture: _Capture
+    _task_profiles: dict[asyncio.Task, tuple]
+    _slow_requests: deque
+
+    def __init__(self, slow_request_seconds: float = SLOW_REQUEST_SECONDS, interval: float = SAMPLING_INTERVAL_SECONDS):
+        self.slow_request_seconds = slow_request_seconds
+        self._interval = interval
+        self._capture = None
+        self._task_profiles = {}
+        self._slow_requests = deque(maxlen=SLOW_REQUESTS_KEPT)
+        self._slow_request_count = 0
+        self._loop = None
+        self._loop_thread_id = None
+        self._sampler_thread = None
+
+    def _sampling_needed(self) -> bool:
+        capture = self._capture
+        return self.slow_request_seconds > 0 or (capture is not None and SAMPLING in capture.profile.modes)
+
+    def _ensure_sampler(self):
+        if self._sampler_thread is None or not self._sampler_thread.is_alive():
+            self._sampler_thread = threading.Thread(target=self._sample_forever, name="profiling-sampler",
+                                                    daemon=True)
+            self._sampler_thread.start()
+
+    def _sample_forever(self):
+        while self._sampling_needed():
+            time.sleep(self._interval)
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None or _is_idle(frame):
+                continue
+            # asyncio has no public way to ask another thread's loop for its running task
+            task = getattr(asyncio.tasks, "_current_tasks", {}).get(self._loop)
+            profiles = self._task_profiles.get(task, ())
+            capture = self._capture
+            if capture is not None and capture.route is None and SAMPLING in capture.profile.modes \
+                    and capture.profile not in profiles:
+                profiles += (capture.profile,)
+            if profiles:
+                stack = {_collapse(frame): 1}
+                for profile in profiles:
+                    if SAMPLING in profile.modes:
+                        profile.add(stack)
+
+    def _request_profiles(self, route: str) -> tuple:
+        profiles = ()
+        capture = self._capture
+        if capture is not None and capture.route in (None, route):
+            profiles += (capture.profile,)
+        if self.slow_request_seconds > 0:
+            profiles += (Profile((SAMPLING,)),)
+        return profiles
+
+    async def handle(self, request: web.Request, handler):
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        profiles = self._request_profiles(route)
+        if not profiles:
+            return await handler(request)
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        if self._sampling_needed():
+            self._ensure_sampler()
+        task = asyncio.current_task()
+        self._task_profiles[task] = profiles
+        token = _current_profiles.set(profiles)
+        start = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            elapsed = time.perf_counter() - start
+            _current_profiles.reset(token)
+            del self._task_profiles[task]
+            if self.slow_request_seconds > 0 and elapsed >= self.slow_request_seconds:
+                self._slow_request_count += 1
+                self._slow_requests.append({'id': self._slow_request_count, 'route': route, 'method': request.method,
+                                            'seconds': elapsed, 'finished': time.time(), 'profile': profiles[-1]})
+
+    async def capture(self, seconds: float, modes: tuple[str, ...], route: str = None) -> Profile:
+        if self._capture is not None:
+            raise ProfileError("A capture is already running")
+        profile = Profile(modes)
+        self._capture = _Capture(profile, route)
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        # cProfile on the event loop thread sees every request at once, so it only runs for unfiltered captures;
+        # with a route only the executor calls of that route are profiled that way
+        profiler = cProfile.Profile() if CPROFILE in modes and route is None else None
+        try:
+            if self._sampling_needed():
+                self._ensure_sampler()
+            if profiler is not None:
+                profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self._capture = None
+        if profiler is not None:
+            profiler.create_stats()
+            profile.add(stats=profiler.stats)
+        return profile
+
+    def slow_requests(self) -> list[dict]:
+        return [{key: value for key, value in slow_request.items() if key != 'profile'}
+                for slow_request in self._slow_requests]
+
+    def slow_request_profile(self, slow_request_id: int) -> Profile:
+        for slow_request in self._slow_requests:
+            if slow_request['id'] == slow_request_id:
+                return slow_request['profile']
+        raise ProfileError("No such slow request")
+
+    def set_slow_request_seconds(self, seconds: float):
+        self.slow_request_seconds = seconds
+        if self._sampling_needed() and self._loop_thread_id is not None:
+            self._ensure_sampler()
+
+
+PROFILER = Profiler()
+
+
+@web.middleware
+async def middleware(request: web.Request, handler):
+    return await PROFILER.handle(request, handler)
+
+
+def _admin_only(handler):
+    async def authorized(request: web.Request) -> web.StreamResponse:
+        if not ADMIN_TOKEN:
+            return errors.error_response(404, 'Not found')
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').encode()
+        if not hmac.compare_digest(supplied, ADMIN_TOKEN.encode()):
+            return errors.error_response(403, 'Admin token required')
+        try:
+            return await handler(request)
+        except ProfileError as error:
+            return errors.error_response(409 if request.method == 'POST' else 404, str(error))
+        except ProfileRequestError as error:
+            return errors.error_response(400, str(error))
+    return authorized
+
+
+def _profile_response(profile: Profile, output_format: str) -> web.Response:
+    if output_format == "pstats":
+        return web.Response(body=profile.pstats_dump(), content_type='application/octet-stream',
+                            headers={'Content-Disposition': 'attachment; filename="profile.pstats"'})
+    if output_format == "text":
+        return web.Response(text=profile.pstats_text())
+    return web.Response(text=profile.collapsed())
+
+
+def _output_format(request: web.Request, modes: tuple[str, ...]) -> str:
+    output_format = request.rel_url.query.get('format', "pstats" if SAMPLING not in modes else "collapsed")
+    if output_format not in FORMATS:
+        raise ProfileRequestError(f"Unknown profile format {output_format}")
+    return output_format
+
+
+@_admin_only
+async def capture_profile(request: web.Request) -> web.Response:
+    # /admin/profile?seconds=10&mode=sampling|cprofile[&route=/finishSigning][&format=collapsed|pstats|text]
+    seconds = min(float(request.rel_url.query.get('seconds', "10")), MAX_CAPTURE_SECONDS)
+    mode = request.rel_url.query.get('mode', SAMPLING)
+    if mode not in MODES:
+        raise ProfileRequestError(f"Unknown profiling mode {mode}")
+    output_format = _output_format(request, (mode,))
+    profile = await PROFILER.capture(seconds, (mode,), request.rel_url.query.get('route'))
+    return _profile_response(profile, output_format)
+
+
+@_admin_only
+async def get_slow_requests(request: web.Request) -> web.Response:
+    return web.json_response({'threshold_seconds': PROFILER.slow_request_seconds,
+                              'requests': PROFILER.slow_requests()})
+
+
+@_admin_only
+async def set_slow_request_threshold(request: web.Request) -> web.Response:
+    PROFILER.set_slow_request_seconds(float(request.rel_url.query['seconds']))
+    return web.json_response({'threshold_seconds': PROFILER.slow_request_seconds})
+
+
+@_admin_only
+async def get_slow_request_profile(request: web.Request) -> web.Response:
+    profile = PROFILER.slow_request_profile(int(request.match_info['request_id']))
+    return _profile_response(profile, _output_format(request, profile.modes))
+
+
+ROUTES_LIST = [
+    web.post('/admin/profile', capture_profile),
+    web.get('/admin/slowRequests', get_slow_requests),
+    web.post('/admin/slowRequests', set_slow_request_threshold),
+    web.get('/admin/slowRequests/{request_id}', get_slow_request_profile),
+]
@@ -0,0 +1,49 @@
+from aiohttp import web
+from datetime import datetime
+import zipfile
+import io
+
+CONTENT_TYPE = "application/zip"
+
+
+class _Chunks(io.RawIOBase):
+    # Write-only and not seekable, so zipfile writes data descriptors instead of seeking back into the response
+    _chunks: list[bytes]
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class ShareArchive:
+    # Zip archive generated into a streamed response: each entry goes out as soon as it is added, only the central
+    # directory records stay in memory until close(). Entries are stored: share values barely compress and deflate
+    # would run on the event loop.
+    _response: web.StreamResponse
+    _chunks: _Chunks
+    _zip: zipfile.ZipFile
+
+    def __init__(self, response: web.StreamResponse):
+        self._response = response
+        self._chunks = _Chunks()
+        self._zip = zipfile.ZipFile(self._chunks, mode="w", compression=zipfile.ZIP_STORED)
+
+    async def add(self, path: str, data: bytes):
+        self._zip.writestr(zipfile.ZipInfo(path, date_time=datetime.now().timetuple()[:6]), data)
+        await self._response.write(self._chunks.take())
+
+    async def close(self):
+        self._zip.close()
+        await self._response.write(self._chunks.take())
@@ -0,0 +1,150 @@
+from aiohttp import web
+import json
+
+from server.utils.utils import SERIALIZATION_ENDIAN
+
+# Binary share (.sss) and public key (.rpk) files. Every integer is written as a 4 byte length followed by its
+# magnitude in SERIALIZATION_ENDIAN order, strings as a 4 byte length followed by UTF-8. Files start with a magic
+# and a format version so uploads can be told apart from the JSON files, which stay supported.
+BINARY_CONTENT_TYPE = "application/x-shamir-share"
+JSON_CONTENT_TYPE = "application/octet-stream"
+SHARE_MAGIC = b"SSSB"
+PUBLIC_KEY_MAGIC = b"SRPK"
+BINARY_FORMAT_VERSION = 1
+_LENGTH_SIZE = 4
+
+
+class ShareFormatError(Exception):
+    pass
+
+
+class _Writer:
+    def __init__(self, magic: bytes):
+        self._chunks = [magic, bytes([BINARY_FORMAT_VERSION])]
+
+    def integer(self, value: int):
+        value_bytes = value.to_bytes((value.bit_length() + 7) // 8, SERIALIZATION_ENDIAN)
+        self._chunks.append(len(value_bytes).to_bytes(_LENGTH_SIZE, SERIALIZATION_ENDIAN))
+        self._chunks.append(value_bytes)
+
+    def string(self, value: str):
+        value_bytes = value.encode()
+        self._chunks.append(len(value_bytes).to_bytes(_LENGTH_SIZE, SERIALIZATION_ENDIAN))
+        self._chunks.append(value_bytes)
+
+    def getvalue(self) -> bytes:
+        return b"".join(self._chunks)
+
+
+class _Reader:
+    def __init__(self, data: bytes, magic: bytes):
+        if data[:len(magic)] != magic:
+            raise ShareFormatError("Unknown file magic")
+        self._data = memoryview(data)
+        self._offset = len(magic) + 1
+        if len(data) < self._offset or data[len(magic)] != BINARY_FORMAT_VERSION:
+            raise ShareFormatError("Unsupported binary format version")
+
+    def _chunk(self) -> memoryview:
+        length_end = self._offset + _LENGTH_SIZE
+        length = int.from_bytes(self._data[self._offset:length_end], SERIALIZATION_ENDIAN)
+        if length_end + length > len(self._data):
+            raise ShareFormatError("Truncated file")
+        self._offset = length_end + length
+        return self._data[length_end:self._offset]
+
+    def integer(self) -> int:
+        return int.from_bytes(self._chunk(), SERIALIZATION_ENDIAN)
+
+    def string(self) -> str:
+        try:
+            return bytes(self._chunk()).decode()
+        except UnicodeDecodeError:
+            raise ShareFormatError("Invalid string")
+
+    def finish(self):
+        if self._offset != len(self._data):
+            raise ShareFormatError("Trailing data")
+
+
+def encode_share(file_fields: dict) -> bytes:
+    writer = _Writer(SHARE_MAGIC)
+    writer.integer(file_fields['format_version'])
+    writer.string(file_fields['name'])
+    writer.string(file_fields['formula'])
+    writer.integer(int(file_fields['public_key']['n']))
+    writer.integer(int(file_fields['public_key']['e']))
+    writer.integer(len(file_fields['share_values']))
+    for value in file_fields['share_values']:
+        writer.integer(value)
+    return writer.getvalue()
+
+
+def encode_public_key(n: int, e: int) -> bytes:
+    writer = _Writer(PUBLIC_KEY_MAGIC)
+    writer.integer(n)
+    writer.integer(e)
+    return writer.getvalue()
+
+
+def decode_share(data: bytes) -> dict:
+    # Both formats decode to the fields of a JSON share file, with the public key numbers already as ints
+    if data.startswith(SHARE_MAGIC):
+        reader = _Reader(data, SHARE_MAGIC)
+        format_version = reader.integer()
+        name = reader.string()
+        formula = reader.string()
+        n = reader.integer()
+        e = reader.integer()
+        share_values = [reader.integer() for _ in range(reader.integer())]
+        reader.finish()
+        return {
+            'format_version': format_version,
+            'name': name,
+            'share_values': share_values,
+            'public_key': {'n': n, 'e': e},
+            'formula': formula
+        }
+    json_object = json.loads(bytes(data).decode())
+    json_object['public_key'] = {'n': int(json_object['public_key']['n']), 'e': int(json_object['public_key']['e'])}
+    return json_object
+
+
+def decode_public_key(data: bytes) -> tuple[int, int]:
+    if data.startswith(PUBLIC_KEY_MAGIC):
+        reader = _Reader(data, PUBLIC_KEY_MAGIC)
+        n = reader.integer()
+        e = reader.integer()
+        reader.finish()
+        return n, e
+    json_object = json.loads(bytes(data).decode())
+    return int(json_object['n']), int(json_object['e'])
+
+
+def wants_binary(request: web.Request) -> bool:
+    return BINARY_CONTENT_TYPE in request.headers.get('Accept', '')
+
+
+def share_file(request: web.Request, file_fields: dict) -> tuple[bytes, str]:
+    if wants_binary(request):
+        return encode_share(file_fields), BINARY_CONTENT_TYPE
+    return json.dumps(file_fields).encode(), JSON_CONTENT_TYPE
+
+
+def share_response(request: web.Request, file_fields: dict, filename: str) -> web.Response:
+    body, content_type = share_file(request, file_fields)
+    resp_headers = {'Content-Type': content_type,
+                    'Content-Disposition': f'attachment; filename="{filename}"',
+                    'Vary': 'Accept'}
+    return web.Response(body=body, headers=resp_headers)
+
+
+def public_key_response(request: web.Request, n: int, e: int, filename: str) -> web.Response:
+    if wants_binary(request):
+        body, content_type = encode_public_key(n, e), BINARY_CONTENT_TYPE
+    else:
+        body, content_type = json.dumps({'n': str(n), 'e': str(e)}).encode(), JSON_CONTENT_TYPE
+    resp_headers = {'Content-Type': content_type,
+                    'Content-Disposition': f'attachment; filename="{filename}"',
+                    'Vary': 'Accept'}
+    return web.Response(body=body, headers=resp_headers)
@@ -0,0 +1,61 @@
+import logging
+import time
+import os
+
+# main.py imports this module before anything else, so the first phase covers every other import
+_START = time.perf_counter()
+READY_MIN_POOLED_KEYS = int(os.environ.get("SHAMIR_READY_MIN_POOLED_KEYS", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimings:
+    # Duration of each startup phase, in the order they finished
+    _phases: dict[str, float]
+    _start: float
+    _last: float
+
+    def __init__(self, start: float):
+        self._phases = {}
+        self._start = start
+        self._last = start
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self._phases[phase] = now - self._last
+        self._last = now
+        logger.info("Startup phase %s took %.3f s (%.3f s since start)", phase, self._phases[phase], now - self._start)
+
+    def phases(self) -> dict[str, float]:
+        return dict(self._phases)
+
+
+class Readiness:
+    # Warm-up steps still running, the instance is ready for traffic once none are left and none failed
+    _pending: set[str]
+    _failed: dict[str, str]
+
+    def __init__(self):
+        self._pending = set()
+        self._failed = {}
+
+    def expect(self, step: str):
+        self._pending.add(step)
+
+    def done(self, step: str):
+        self._pending.discard(step)
+
+    def failed(self, step: str, reason: str):
+        self._pending.discard(step)
+        self._failed[step] = reason
+
+    @property
+    def ready(self) -> bool:
+        return not self._pending and not self._failed
+
+    def stats(self) -> dict:
+        return {'ready': self.ready, 'pending': sorted(self._pending), 'failed': self._failed}
+
+
+TIMINGS = StartupTimings(_START)
+READINESS = Readiness()
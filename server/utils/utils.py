@@ -2,102 +2,232 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.asymmetric import utils as cryptography_utils
 from cryptography.hazmat.primitives import hashes
-from pypdf import PdfReader
-from pypdf import PdfWriter
+from cryptography.exceptions import InvalidSignature
 from io import BytesIO
+from typing import TYPE_CHECKING
 from zlib import crc32
+from server.utils import metrics
 import base64
+import importlib
+import math
+
+if TYPE_CHECKING:
+    from pypdf import PdfReader
 
 SERIALIZATION_ENDIAN = "little"
+# Trailing byte of an encoded private key. Format 1 carries d and needs a factoring search to rebuild the CRT
+# parameters, format 2 carries the prime p, from which everything else follows directly
+PRIVATE_KEY_FORMAT_VERSION = 2
+SIGNATURE_METADATA_KEY = '/shamir_signature'
+SIGNED_LENGTH_METADATA_KEY = '/shamir_signed_length'
+# pypdf is imported by the functions using it: it is the largest import of the server and PDFs are only ever handled
+# inside executor workers, which import it during warm_up()
 
 class PrivateKeyChecksumError(Exception):
     pass
 
 
+class PrivateKeyFormatError(Exception):
+    pass
+
+
+class SignatureFormatError(Exception):
+    pass
+
+
 def _byte_length(integer: int) -> int:
     return (integer.bit_length() + 7) // 8
 
 
 def _restore_private_key(n: int, e: int, d: int) -> rsa.RSAPrivateKey:
     p, q = rsa.rsa_recover_prime_factors(n, e, d)
+    return _private_key_from_factors(n, e, d, p, q)
+
+
+def _restore_private_key_from_prime(n: int, e: int, p: int) -> rsa.RSAPrivateKey:
+    q, remainder = divmod(n, p)
+    if remainder or p in (1, n):
+        raise PrivateKeyChecksumError()
+    d = pow(e, -1, math.lcm(p - 1, q - 1))
+    return _private_key_from_factors(n, e, d, p, q)
+
+
+def _private_key_from_factors(n: int, e: int, d: int, p: int, q: int) -> rsa.RSAPrivateKey:
     iqmp = rsa.rsa_crt_iqmp(p, q)
     dmp1 = rsa.rsa_crt_dmp1(d, p)
     dmq1 = rsa.rsa_crt_dmp1(d, q)
-    return rsa.RSAPrivateNumbers(p, q, d, dmp1, dmq1, iqmp, rsa.RSAPublicNumbers(e, n)).private_key()
+    # p * q == n is known at this point, OpenSSL's primality re-check of the factors would dominate the restore
+    return rsa.RSAPrivateNumbers(p, q, d, dmp1, dmq1, iqmp,
+                                 rsa.RSAPublicNumbers(e, n)).private_key(unsafe_skip_rsa_key_validation=True)
 
 
-def _adjust_pdf(pdf_data):
+def _sha256(data: bytes) -> bytes:
+    digest = hashes.Hash(hashes.SHA256())
+    digest.update(data)
+    return digest.finalize()
+
+
+class _HashingBytesIO(BytesIO):
+    # Hashes the document while pypdf writes it, as long as the writer only ever appends
+    def __init__(self):
+        super().__init__()
+        self._digest = hashes.Hash(hashes.SHA256())
+        self._hashed_length = 0
+        self._sequential = True
+
+    def write(self, data) -> int:
+        if self._digest is not None:
+            if self.tell() != self._hashed_length:
+                self._sequential = False
+            if self._sequential:
+                self._digest.update(data)
+                self._hashed_length += len(data)
+        return super().write(data)
+
+    def hash_value(self) -> bytes:
+        # Finalizes the hash, anything written afterwards is not covered by it
+        digest, self._digest = self._digest, None
+        if self._sequential:
+            return digest.finalize()
+        return _sha256(self.getbuffer())
+
+
+def _canonicalize_pdf(pdf_data: bytes) -> (_HashingBytesIO, bytes):
+    from pypdf import PdfReader, PdfWriter
     pdf_reader = PdfReader(BytesIO(pdf_data))
     pdf_writer = PdfWriter()
     pdf_writer.append_pages_from_reader(pdf_reader)
     pdf_writer.add_metadata(pdf_reader.metadata)
-    bytes_io = BytesIO()
-    pdf_writer.write(bytes_io)
-    bytes_io.seek(0)
-    return bytes_io.read()
-
-
-def private_key_to_int(private_key: rsa.RSAPrivateKey) -> int:
-    key_d = private_key.private_numbers().d
-    key_d_bytes = key_d.to_bytes(_byte_length(key_d), SERIALIZATION_ENDIAN)
-    checksum = crc32(key_d_bytes)
-    key_d_bytes += checksum.to_bytes(4, SERIALIZATION_ENDIAN)
-    key_d_bytes += bytes([1])  # prevent bytes loss
-    return int.from_bytes(key_d_bytes, SERIALIZATION_ENDIAN)
+    output_stream = _HashingBytesIO()
+    pdf_writer.write(output_stream)
+    return output_stream, output_stream.hash_value()
+
+
+def _signature_update(signed_data: bytes, signature: bytes) -> bytes:
+    # PDF incremental update that replaces the document information dictionary with a copy carrying the signature
+    # and the length of the signed prefix, the signed bytes themselves are left untouched
+    from pypdf import PdfReader
+    from pypdf.generic import DictionaryObject, NameObject, NumberObject, TextStringObject
+    pdf_reader = PdfReader(BytesIO(signed_data))
+    trailer = DictionaryObject(pdf_reader.trailer)
+    info_reference = trailer.raw_get('/Info')
+    info = DictionaryObject(info_reference.get_object())
+    info[NameObject(SIGNATURE_METADATA_KEY)] = TextStringObject(base64.b64encode(signature).decode('ascii'))
+    info[NameObject(SIGNED_LENGTH_METADATA_KEY)] = NumberObject(len(signed_data))
+    previous_xref = int(signed_data[signed_data.rindex(b'startxref') + len(b'startxref'):].split()[0])
+    trailer[NameObject('/Prev')] = NumberObject(previous_xref)
+
+    update_stream = BytesIO()
+    update_stream.write(b'\n%d %d obj\n' % (info_reference.idnum, info_reference.generation))
+    info.write_to_stream(update_stream, None)
+    update_stream.write(b'\nendobj\n')
+    xref_offset = len(signed_data) + update_stream.tell()
+    update_stream.write(b'xref\n%d 1\n%010d %05d n \n' % (info_reference.idnum, len(signed_data) + 1,
+                                                           info_reference.generation))
+    update_stream.write(b'trailer\n')
+    trailer.write_to_stream(update_stream, None)
+    update_stream.write(b'\nstartxref\n%d\n%%%%EOF\n' % xref_offset)
+    return update_stream.getvalue()
+
+
+def private_key_to_int(private_key: rsa.RSAPrivateKey, format_version: int = PRIVATE_KEY_FORMAT_VERSION) -> int:
+    if format_version == 1:
+        key_value = private_key.private_numbers().d
+    elif format_version == 2:
+        key_value = private_key.private_numbers().p
+    else:
+        raise PrivateKeyFormatError()
+    key_bytes = key_value.to_bytes(_byte_length(key_value), SERIALIZATION_ENDIAN)
+    checksum = crc32(key_bytes)
+    key_bytes += checksum.to_bytes(4, SERIALIZATION_ENDIAN)
+    key_bytes += bytes([format_version])  # also prevents the loss of trailing zero bytes
+    return int.from_bytes(key_bytes, SERIALIZATION_ENDIAN)
 
 
 def int_to_private_key(converted_key: int, public_key: rsa.RSAPublicKey) -> rsa.RSAPrivateKey:
     raw_bytes = converted_key.to_bytes(_byte_length(converted_key), SERIALIZATION_ENDIAN)
+    format_version = raw_bytes[-1]
     checksum_bytes = raw_bytes[-5:-1]
     checksum = int.from_bytes(checksum_bytes, SERIALIZATION_ENDIAN)
-    key_d_bytes = raw_bytes[:-5]
-    if crc32(key_d_bytes) != checksum:
+    key_bytes = raw_bytes[:-5]
+    if crc32(key_bytes) != checksum:
         raise PrivateKeyChecksumError()
-    return _restore_private_key(public_key.public_numbers().n, public_key.public_numbers().e,
-                                int.from_bytes(key_d_bytes, SERIALIZATION_ENDIAN))
+    public_numbers = public_key.public_numbers()
+    key_value = int.from_bytes(key_bytes, SERIALIZATION_ENDIAN)
+    if format_version == 1:
+        return _restore_private_key(public_numbers.n, public_numbers.e, key_value)
+    if format_version == 2:
+        return _restore_private_key_from_prime(public_numbers.n, public_numbers.e, key_value)
+    raise PrivateKeyFormatError()
+
+
+def warm_up():
+    importlib.import_module("pypdf")
+
+
+def canonicalize_pdf(pdf_data: bytes) -> (bytes, bytes):
+    # Returns the rewritten document that gets signed and its SHA-256
+    with metrics.stage("pdf_adjust"):
+        canonical_stream, hash_value = _canonicalize_pdf(pdf_data)
+    return canonical_stream.getvalue(), hash_value
+
+
+def sign_canonical_pdf(canonical_data: bytes, hash_value: bytes, private_key: rsa.RSAPrivateKey) -> bytes:
+    with metrics.stage("sign"):
+        signature = private_key.sign(
+            hash_value,
+            padding.PSS(
+                mgf=padding.MGF1(hashes.SHA256()),
+                salt_length=padding.PSS.MAX_LENGTH
+            ),
+            cryptography_utils.Prehashed(hashes.SHA256())
+        )
+    return canonical_data + _signature_update(canonical_data, signature)
 
 
 def add_signature_to_pdf(pdf_data: bytes, private_key: rsa.RSAPrivateKey) -> bytes:
-    adjusted_data = _adjust_pdf(pdf_data)
-    digest = hashes.Hash(hashes.SHA256())
-    digest.update(adjusted_data)
-    hash_value = digest.finalize()
-    signature = private_key.sign(
-        hash_value,
-        padding.PSS(
-            mgf=padding.MGF1(hashes.SHA256()),
-            salt_length=padding.PSS.MAX_LENGTH
-        ),
-        cryptography_utils.Prehashed(hashes.SHA256())
-    )
-    pdf_reader = PdfReader(BytesIO(adjusted_data))
-    pdf_writer = PdfWriter()
-    pdf_writer.append_pages_from_reader(pdf_reader)
-    pdf_writer.add_metadata(pdf_reader.metadata)
-    pdf_writer.add_metadata({'/shamir_signature': base64.b64encode(signature).decode('ascii')})
-    output_stream = BytesIO()
-    pdf_writer.write(output_stream)
-    output_stream.seek(0)
-    return output_stream.read()
+    return sign_canonical_pdf(*canonicalize_pdf(pdf_data), private_key)
 
 
-def verify_pdf_signature(pdf_data: bytes, e: int, n: int) -> None:
-    public_key = rsa.RSAPublicNumbers(e, n).public_key()
-    pdf_reader = PdfReader(BytesIO(pdf_data))
-    metadata_values = pdf_reader.metadata.values()
-    signature = base64.b64decode(metadata_values.mapping['/shamir_signature'])
+def _legacy_signed_hash(pdf_reader: "PdfReader") -> bytes:
+    # Documents signed before incremental updates were used carry the signature in a fully rewritten file
+    from pypdf import PdfWriter
     pdf_writer = PdfWriter()
     pdf_writer.append_pages_from_reader(pdf_reader)
     metadata_dict = pdf_reader.metadata
-    metadata_dict.pop('/shamir_signature')
+    metadata_dict.pop(SIGNATURE_METADATA_KEY)
     pdf_writer.add_metadata(metadata_dict)
     bytes_io = BytesIO()
     pdf_writer.write(bytes_io)
-    bytes_io.seek(0)
-    source_pdf_data = bytes_io.read()
-    digest = hashes.Hash(hashes.SHA256())
-    digest.update(source_pdf_data)
-    hash_value = digest.finalize()
-    return public_key.verify(signature, hash_value,
-                             padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
-                             cryptography_utils.Prehashed(hashes.SHA256()))
+    return _sha256(bytes_io.getbuffer())
+
+
+def verify_pdf_signature(pdf_data: bytes, e: int, n: int) -> None:
+    with metrics.stage("verify"):
+        return _verify_pdf_signature(pdf_data, e, n)
+
+
+def _verify_pdf_signature(pdf_data: bytes, e: int, n: int) -> None:
+    # Raises InvalidSignature, or SignatureFormatError for an unusable key, PDF or signature: both only depend on the
+    # document and the key. Any other error (memory, I/O) may not happen again.
+    from pypdf import PdfReader
+    from pypdf.errors import PyPdfError
+    try:
+        public_key = rsa.RSAPublicNumbers(e, n).public_key()
+        pdf_reader = PdfReader(BytesIO(pdf_data))
+        metadata = pdf_reader.metadata
+        signature = base64.b64decode(metadata[SIGNATURE_METADATA_KEY])
+        if SIGNED_LENGTH_METADATA_KEY in metadata:
+            signed_length = int(metadata[SIGNED_LENGTH_METADATA_KEY])
+            signed_data = pdf_data[:signed_length]
+            # Anything appended after the signature update, including later incremental updates, is rejected
+            if _signature_update(signed_data, signature) != pdf_data[signed_length:]:
+                raise InvalidSignature()
+            hash_value = _sha256(signed_data)
+        else:
+            hash_value = _legacy_signed_hash(pdf_reader)
+        return public_key.verify(signature, hash_value,
+                                 padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+                                 cryptography_utils.Prehashed(hashes.SHA256()))
+    except (PyPdfError, KeyError, TypeError, ValueError) as error:
+        raise SignatureFormatError() from error
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+import hashlib
+import os
+
+VERIFICATION_CACHE_SIZE = int(os.environ.get("SHAMIR_VERIFICATION_CACHE_SIZE", "4096"))
+
+
+def key_fingerprint(n: int, e: int) -> str:
+    return hashlib.sha256(f"{n}:{e}".encode()).hexdigest()
+
+
+class VerificationCache:
+    # Verification outcomes keyed by (document SHA-256, public key fingerprint). Both outcomes are cached, a
+    # document either carries a valid signature for a key or it never will
+    _results: OrderedDict[tuple[str, str], bool]
+    _size: int
+
+    def __init__(self, size: int = VERIFICATION_CACHE_SIZE):
+        self._results = OrderedDict()
+        self._size = size
+        self._hits_count = 0
+        self._misses_count = 0
+
+    def get(self, document_sha256: str, fingerprint: str) -> bool:
+        key = (document_sha256, fingerprint)
+        result = self._results.get(key)
+        if result is None:
+            self._misses_count += 1
+            return None
+        self._results.move_to_end(key)
+        self._hits_count += 1
+        return result
+
+    def put(self, document_sha256: str, fingerprint: str, result: bool):
+        if self._size <= 0:
+            return
+        self._results[(document_sha256, fingerprint)] = result
+        self._results.move_to_end((document_sha256, fingerprint))
+        while len(self._results) > self._size:
+            self._results.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._results),
+            'max_size': self._size,
+            'hits': self._hits_count,
+            'misses': self._misses_count
+        }
+
+
+VERIFICATION_CACHE = VerificationCache()
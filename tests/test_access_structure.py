@@ -0,0 +1,118 @@
+from itertools import combinations
+import pytest
+
+from server.utils.access_structure import AccessStructure, FormulaParseError
+
+FORMULAS = [
+    "T1(a)",
+    "T2(a,b,c)",
+    "T3(a,b,c)",
+    "T2(a, T1(b,c), T2(d,e,f))",
+    "T1(T2(a,b),T2(c,d))",
+    "T2(T2(a,b,c),T1(d),T3(e,f,g))",
+]
+
+
+def _subsets(names: list[str]):
+    for size in range(len(names) + 1):
+        yield from combinations(names, size)
+
+
+def _satisfied(access_structure: AccessStructure, names) -> bool:
+    counts = access_structure.counts()
+    satisfied = False
+    for name in names:
+        satisfied = access_structure.add(counts, name)
+    return satisfied
+
+
+def _expected(formula: str, names: set[str]) -> bool:
+    # Straightforward recursive evaluation of the formula, independent of the gate counting
+    def evaluate(position: int) -> (bool, int):
+        threshold_end = formula.index("(", position)
+        threshold = int(formula[position + 1:threshold_end])
+        position = threshold_end + 1
+        satisfied_children = 0
+        while True:
+            if formula[position] == "T":
+                child, position = evaluate(position)
+            else:
+                end = position
+                while formula[end] not in ",)":
+                    end += 1
+                child = formula[position:end] in names
+                position = end
+            satisfied_children += child
+            position += 1
+            if formula[position - 1] == ")":
+                return satisfied_children >= threshold, position
+    return evaluate(0)[0]
+
+
+@pytest.mark.parametrize("formula", FORMULAS)
+def test_every_subset_matches_formula(formula):
+    access_structure = AccessStructure(formula)
+    for subset in _subsets(access_structure.names()):
+        assert _satisfied(access_structure, subset) == _expected(formula.replace(" ", ""), set(subset)), subset
+
+
+@pytest.mark.parametrize("formula", FORMULAS)
+def test_order_of_shares_does_not_matter(formula):
+    access_structure = AccessStructure(formula)
+    names = access_structure.names()
+    assert _satisfied(access_structure, names) == _satisfied(access_structure, list(reversed(names)))
+
+
+def test_unknown_names_are_ignored():
+    access_structure = AccessStructure("T2(a,b,c)")
+    assert not _satisfied(access_structure, ["a", "x", "y"])
+    assert _satisfied(access_structure, ["a", "x", "c"])
+
+
+def test_counts_are_per_set_of_names():
+    access_structure = AccessStructure("T2(a,b,c)")
+    first = access_structure.counts()
+    second = access_structure.counts()
+    assert not access_structure.add(first, "a")
+    assert access_structure.add(first, "b")
+    assert not access_structure.add(second, "c")
+
+
+def test_names_in_formula_order():
+    assert AccessStructure("T2(a, T1(b,c), T2(d,e,f))").names() == ["a", "b", "c", "d", "e", "f"]
+
+
+@pytest.mark.parametrize("formula", [
+    "",
+    "a",
+    "T2(a)",
+    "T0(a,b)",
+    "T1()",
+    "T1(a,)",
+    "T1(a",
+    "T1(a) b",
+    "T1(a)(b)",
+    "T2(a,a,b)",
+    "T1(a,T1(a))",
+])
+def test_formulas_beyond_the_parser(formula):
+    with pytest.raises(FormulaParseError):
+        AccessStructure(formula)
+
+
+@pytest.mark.parametrize("formula", FORMULAS)
+def test_matches_secret_sharing(formula):
+    # Rooms decide quorums with AccessStructure and only restore once: both must agree on every set of shares
+    secret_sharing = pytest.importorskip("secret_sharing")
+    from server.models.RoomsManagers import CONFIGURATION_MODULO
+
+    configuration = secret_sharing.Configuration(modulo=CONFIGURATION_MODULO, formula=formula)
+    secret = 0x5EC12E7
+    parts = {part.name: part for part in configuration.split(secret)}
+    access_structure = AccessStructure(formula)
+    for subset in _subsets(access_structure.names()):
+        try:
+            restored = configuration.restore([parts[name] for name in subset]) == secret
+        except Exception:
+            restored = False
+        assert _satisfied(access_structure, subset) == restored, subset
@@ -0,0 +1,72 @@
+import json
+import pytest
+
+from server.utils import share_format
+
+FILE_FIELDS = {
+    'format_version': 2,
+    'name': "alice",
+    'share_values': [0, 1, 2 ** 4000 - 1, 123456789],
+    'public_key': {'n': str(2 ** 2048 + 981), 'e': "65537"},
+    'formula': "T2(alice,bob,carol)"
+}
+
+
+def _decoded_fields() -> dict:
+    return {**FILE_FIELDS, 'public_key': {'n': 2 ** 2048 + 981, 'e': 65537}}
+
+
+def test_share_round_trip():
+    assert share_format.decode_share(share_format.encode_share(FILE_FIELDS)) == _decoded_fields()
+
+
+def test_share_with_unicode_name_and_no_values():
+    file_fields = {**FILE_FIELDS, 'name': "zoë", 'share_values': []}
+    decoded = share_format.decode_share(share_format.encode_share(file_fields))
+    assert decoded['name'] == "zoë"
+    assert decoded['share_values'] == []
+
+
+def test_json_share_still_decodes():
+    assert share_format.decode_share(json.dumps(FILE_FIELDS).encode()) == _decoded_fields()
+
+
+def test_public_key_round_trip():
+    assert share_format.decode_public_key(share_format.encode_public_key(2 ** 2048 + 981, 65537)) == \
+        (2 ** 2048 + 981, 65537)
+    assert share_format.decode_public_key(json.dumps({'n': "15", 'e': "3"}).encode()) == (15, 3)
+
+
+def test_every_truncation_is_rejected():
+    data = share_format.encode_share(FILE_FIELDS)
+    for length in range(len(share_format.SHARE_MAGIC), len(data)):
+        with pytest.raises(share_format.ShareFormatError):
+            share_format.decode_share(data[:length])
+
+
+def test_trailing_data_is_rejected():
+    with pytest.raises(share_format.ShareFormatError):
+        share_format.decode_share(share_format.encode_share(FILE_FIELDS) + b"\x00")
+    with pytest.raises(share_format.ShareFormatError):
+        share_format.decode_public_key(share_format.encode_public_key(15, 3) + b"\x00")
+
+
+def test_unsupported_version_is_rejected():
+    data = bytearray(share_format.encode_share(FILE_FIELDS))
+    data[len(share_format.SHARE_MAGIC)] = share_format.BINARY_FORMAT_VERSION + 1
+    with pytest.raises(share_format.ShareFormatError):
+        share_format.decode_share(bytes(data))
+
+
+def test_oversized_length_is_rejected():
+    data = share_format.SHARE_MAGIC + bytes([share_format.BINARY_FORMAT_VERSION]) + b"\xff\xff\xff\xff\x01"
+    with pytest.raises(share_format.ShareFormatError):
+        share_format.decode_share(data)
+
+
+def test_invalid_utf8_name_is_rejected():
+    data = share_format.encode_share({**FILE_FIELDS, 'name': "ab"})
+    data = data.replace(b"ab", b"\xff\xfe", 1)
+    with pytest.raises(share_format.ShareFormatError):
+        share_format.decode_share(data)
+
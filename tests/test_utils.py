@@ -0,0 +1,129 @@
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric import utils as cryptography_utils
+from cryptography.hazmat.primitives import hashes
+from cryptography.exceptions import InvalidSignature
+from pypdf import PdfReader, PdfWriter
+from io import BytesIO
+import base64
+import pytest
+
+from server.utils import utils
+
+
+@pytest.fixture(scope="module")
+def private_key() -> rsa.RSAPrivateKey:
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def _assert_same_key(restored: rsa.RSAPrivateKey, private_key: rsa.RSAPrivateKey):
+    restored_numbers, numbers = restored.private_numbers(), private_key.private_numbers()
+    assert restored_numbers.public_numbers == numbers.public_numbers
+    assert {restored_numbers.p, restored_numbers.q} == {numbers.p, numbers.q}
+    assert restored_numbers.d % (numbers.p - 1) == numbers.dmp1
+    assert restored_numbers.d % (numbers.q - 1) == numbers.dmq1
+
+
+@pytest.mark.parametrize("format_version", [1, 2])
+def test_private_key_round_trip(private_key, format_version):
+    key_int = utils.private_key_to_int(private_key, format_version)
+    _assert_same_key(utils.int_to_private_key(key_int, private_key.public_key()), private_key)
+
+
+def test_private_key_default_format(private_key):
+    key_int = utils.private_key_to_int(private_key)
+    assert key_int >> (8 * (utils._byte_length(key_int) - 1)) == utils.PRIVATE_KEY_FORMAT_VERSION
+
+
+def test_private_key_checksum_is_checked(private_key):
+    key_int = utils.private_key_to_int(private_key) ^ (1 << 8)
+    with pytest.raises(utils.PrivateKeyChecksumError):
+        utils.int_to_private_key(key_int, private_key.public_key())
+
+
+def test_private_key_unknown_format_is_rejected(private_key):
+    with pytest.raises(utils.PrivateKeyFormatError):
+        utils.private_key_to_int(private_key, 3)
+    key_int = utils.private_key_to_int(private_key)
+    key_int += (3 - utils.PRIVATE_KEY_FORMAT_VERSION) << (8 * (utils._byte_length(key_int) - 1))
+    with pytest.raises(utils.PrivateKeyFormatError):
+        utils.int_to_private_key(key_int, private_key.public_key())
+
+
+@pytest.fixture(scope="module")
+def pdf_data() -> bytes:
+    pdf_writer = PdfWriter()
+    for _ in range(3):
+        pdf_writer.add_blank_page(200, 200)
+    pdf_writer.add_metadata({'/Title': "Contract"})
+    output_stream = BytesIO()
+    pdf_writer.write(output_stream)
+    return output_stream.getvalue()
+
+
+def _rewrite(pdf_reader: PdfReader, metadata: dict) -> bytes:
+    pdf_writer = PdfWriter()
+    pdf_writer.append_pages_from_reader(pdf_reader)
+    pdf_writer.add_metadata(metadata)
+    output_stream = BytesIO()
+    pdf_writer.write(output_stream)
+    return output_stream.getvalue()
+
+
+def _baseline_signed_pdf(pdf_data: bytes, private_key: rsa.RSAPrivateKey) -> bytes:
+    # How documents were signed before incremental updates: the signature sits in a second full rewrite
+    pdf_reader = PdfReader(BytesIO(pdf_data))
+    adjusted_data = _rewrite(pdf_reader, pdf_reader.metadata)
+    signature = private_key.sign(utils._sha256(adjusted_data),
+                                 padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH),
+                                 cryptography_utils.Prehashed(hashes.SHA256()))
+    adjusted_reader = PdfReader(BytesIO(adjusted_data))
+    return _rewrite(adjusted_reader, {**adjusted_reader.metadata,
+                                      utils.SIGNATURE_METADATA_KEY: base64.b64encode(signature).decode('ascii')})
+
+
+def _verify(signed_data: bytes, private_key: rsa.RSAPrivateKey):
+    public_numbers = private_key.public_key().public_numbers()
+    utils.verify_pdf_signature(signed_data, public_numbers.e, public_numbers.n)
+
+
+def test_signed_pdf_verifies(pdf_data, private_key):
+    signed_data = utils.add_signature_to_pdf(pdf_data, private_key)
+    _verify(signed_data, private_key)
+    pdf_reader = PdfReader(BytesIO(signed_data))
+    assert len(pdf_reader.pages) == 3
+    assert pdf_reader.metadata['/Title'] == "Contract"
+
+
+def test_signature_is_an_incremental_update(pdf_data, private_key):
+    canonical_data, hash_value = utils.canonicalize_pdf(pdf_data)
+    assert hash_value == utils._sha256(canonical_data)
+    signed_data = utils.sign_canonical_pdf(canonical_data, hash_value, private_key)
+    assert signed_data.startswith(canonical_data)
+    _verify(signed_data, private_key)
+
+
+def test_baseline_signed_pdf_verifies(pdf_data, private_key):
+    _verify(_baseline_signed_pdf(pdf_data, private_key), private_key)
+
+
+def test_appended_bytes_are_rejected(pdf_data, private_key):
+    signed_data = utils.add_signature_to_pdf(pdf_data, private_key)
+    with pytest.raises(InvalidSignature):
+        _verify(signed_data + b"\n%appended\n", private_key)
+
+
+def test_other_key_is_rejected(pdf_data, private_key):
+    signed_data = utils.add_signature_to_pdf(pdf_data, private_key)
+    other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with pytest.raises(InvalidSignature):
+        _verify(signed_data, other_key)
+    with pytest.raises(InvalidSignature):
+        _verify(_baseline_signed_pdf(pdf_data, private_key), other_key)
+
+
+def test_unsigned_pdf_is_a_format_error(pdf_data, private_key):
+    with pytest.raises(utils.SignatureFormatError):
+        _verify(pdf_data, private_key)
+    with pytest.raises(utils.SignatureFormatError):
+        _verify(b"not a pdf", private_key)